@@ -0,0 +1,182 @@
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from unittest import mock
+import main
+from tests import FakeS3Client, FakeS3Resource, FakeSESClient, FakeSheetsClient, create_test_signing_context
+
+# runs main() end to end against in-process fakes of google sheets, s3, ses and sns on synthetic member sheets,
+# and reports the throughput and the latency of each pipeline stage
+BENCHMARK_SIZES = [100, 1000, 10000]
+BENCHMARK_RESULTS_PATH = 'benchmark_results.json'
+BENCHMARK_MAX_REGRESSION = 0.2
+
+HEBREW_FIRST_NAMES = [('אבי', 'Avi'), ('דני', 'Dani'), ('יוסי', 'Yossi'), ('מיכל', 'Michal'), ('נועה', 'Noa'), ('רונית', 'Ronit'), ('עומר', 'Omer'), ('שירה', 'Shira'), ('איתי', 'Itay'), ('תמר', 'Tamar')]
+HEBREW_LAST_NAMES = [('כהן', 'Cohen'), ('לוי', 'Levi'), ('מזרחי', 'Mizrahi'), ('פרץ', 'Peretz'), ('ביטון', 'Biton'), ('אברהם', 'Avraham'), ('פרידמן', 'Friedman'), ('שפירא', 'Shapira')]
+MOTORCYCLE_MODELS = ['Monster', 'Panigale V4', 'Multistrada V4', 'Scrambler Icon', 'Diavel V4', 'SuperSport 950', 'Streetfighter V2', 'DesertX']
+ROLES = ['', '', '', '', 'חבר ועד', 'רכז אזור']
+BOT_STATUSES = [main.STATUS_ISSUE] * 15 + [main.STATUS_UPDATE] * 4 + [main.STATUS_UPDATE_TYPO] + [''] * 80
+
+
+def generate_items(rows_count, now, seed=0):
+    rng = random.Random(seed)
+    items = []
+    for index in range(rows_count):
+        hebrew_first_name, english_first_name = rng.choice(HEBREW_FIRST_NAMES)
+        hebrew_last_name, english_last_name = rng.choice(HEBREW_LAST_NAMES)
+        membership_expiration = now + datetime.timedelta(days=rng.randint(-60, 400))
+        items.append({
+            'כתובת אימייל': f'{english_first_name}.{english_last_name}{index}@example.com'.lower(),
+            'טלפון סלולרי': '' if rng.random() < 0.01 else f'05{rng.randint(0, 8)}-{rng.randint(0, 9999999):07d}',
+            'חברות': str(membership_expiration.year),
+            'קוד דוקאטי': '' if rng.random() < 0.03 else str(rng.randint(10000, 99999)),
+            'תפקיד': rng.choice(ROLES),
+            'שם מלא בעברית': f'{hebrew_first_name} {hebrew_last_name}',
+            'שם מלא באנגלית': f'{english_first_name} {english_last_name}',
+            'אישור': '',
+            'דגם אופנוע נוכחי': rng.choice(MOTORCYCLE_MODELS),
+            'תפוגה': membership_expiration.strftime('%Y-%m-%d'),
+            main.HEADER_LAST_RENEWAL_REMINDER_DATE: '',
+            'זוגי': 'y' if rng.random() < 0.1 else '',
+            'עזב': 'y' if rng.random() < 0.02 else '',
+            main.HEADER_BOT_STATUS: rng.choice(BOT_STATUSES),
+            'id': index + 1,
+        })
+    return items
+
+
+class SlowClient:
+    # delays every call to the wrapped fake client by the simulated network latency
+
+    def __init__(self, client, latency_seconds):
+        self._client = client
+        self._latency_seconds = latency_seconds
+
+    def __getattr__(self, name):
+        value = getattr(self._client, name)
+        if not callable(value) or not self._latency_seconds:
+            return value
+
+        def slow_call(*args, **kwargs):
+            time.sleep(self._latency_seconds)
+            return value(*args, **kwargs)
+        return slow_call
+
+
+class FakeSNSClient:
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, PhoneNumber, Message, MessageAttributes):
+        self.messages.append((PhoneNumber, Message))
+        return {'MessageId': str(len(self.messages))}
+
+
+def run_benchmark(rows_count, signing_context, latency_seconds=0, seed=0, keep_rate_limits=False, signing_workers=1):
+    now = datetime.datetime.now()
+    items = generate_items(rows_count, now, seed)
+    s3_client = FakeS3Client()
+    services = main.ServiceContainer()
+    services.google_sheets_client = FakeSheetsClient(items)
+    services.google_sheets_client.google_sheets_resource = SlowClient(services.google_sheets_client.google_sheets_resource, latency_seconds)
+    services.aws_s3_resource = FakeS3Resource(SlowClient(s3_client, latency_seconds))
+    services.aws_s3_publisher_client = services.aws_s3_resource.meta.client
+    services.aws_ses_client = SlowClient(FakeSESClient(), latency_seconds)
+    services.aws_sns_client = SlowClient(FakeSNSClient(), latency_seconds)
+    services.aws_s3_bucket_name = 'benchmark'
+    services.contact_phone_number = '0500000000'
+
+    rate_limiters = main.rate_limiters if keep_rate_limits else {name: main.RateLimiter(name, 1e9) for name in main.RATE_LIMITS_PER_SECOND}
+    with tempfile.TemporaryDirectory() as state_dir, contextlib.ExitStack() as exit_stack:
+        for name, value in [
+            ('services', services),
+            ('rate_limiters', rate_limiters),
+            ('_apple_pass_signing_context', signing_context),
+            ('STATE_DB_PATH', os.path.join(state_dir, 'state.sqlite3')),
+            ('RUN_METRICS_PATH', None),
+            ('RUN_METRICS_PROMETHEUS_PATH', None),
+            ('MAX_DOCUMENT_UPDATES', rows_count * 2),  # every pending row is processed in a single run
+            ('APPLE_CARD_SIGNING_WORKERS', signing_workers),
+        ]:
+            exit_stack.enter_context(mock.patch.object(main, name, value))
+
+        started = time.perf_counter()
+        main.main()
+        seconds = time.perf_counter() - started
+
+    summary = main.run_metrics.summary()
+    cards_count = sum(1 for _, key in s3_client.objects if key.startswith('apple_card/'))
+    return {
+        'rows': rows_count,
+        'cards': cards_count,
+        'renewal_reminders': summary['counters'].get('renewal_notifications', 0),
+        'seconds': round(seconds, 6),
+        'rows_per_second': round(rows_count / seconds, 3),
+        'cards_per_second': round(cards_count / seconds, 3),
+        'counters': summary['counters'],
+        'stages': summary['stages'],
+    }
+
+
+def find_regressions(results, baseline_results, max_regression=BENCHMARK_MAX_REGRESSION):
+    baseline_runs = {run['rows']: run for run in baseline_results['runs']}
+    regressions = []
+    for run in results['runs']:
+        baseline_run = baseline_runs.get(run['rows'])
+        if not baseline_run:
+            continue
+        for metric in ['rows_per_second', 'cards_per_second']:
+            if baseline_run[metric] and run[metric] < baseline_run[metric] * (1 - max_regression):
+                regressions.append(f'{run["rows"]} rows: {metric} dropped from {baseline_run[metric]} to {run[metric]}')
+    return regressions
+
+
+def print_results(results):
+    for run in results['runs']:
+        print(f'{run["rows"]} rows: {run["seconds"]:.3f}s, {run["rows_per_second"]:.1f} rows/s, {run["cards"]} cards, {run["cards_per_second"]:.1f} cards/s')
+        for stage, stage_summary in run['stages'].items():
+            print(f'  {stage:<30} n={stage_summary["count"]:<6} total={stage_summary["total_seconds"]:.3f}s p50={stage_summary["p50_seconds"] * 1000:.3f}ms p95={stage_summary["p95_seconds"] * 1000:.3f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCHMARK_SIZES, metavar='ROWS', help='synthetic sheet sizes to run')
+    parser.add_argument('--latency-ms', type=float, default=0, help='simulated network latency of every fake sheets, s3, ses and sns call')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--signing-workers', type=int, default=1, help='APPLE_CARD_SIGNING_WORKERS, with workers create_apple_wallet_card measures the wait for the signed card')
+    parser.add_argument('--keep-rate-limits', action='store_true', help='keep the configured rate limits instead of disabling them')
+    parser.add_argument('--output', default=BENCHMARK_RESULTS_PATH, help='path of the json results')
+    parser.add_argument('--baseline', help='json results of an earlier run, exits with an error when throughput regressed')
+    parser.add_argument('--max-regression', type=float, default=BENCHMARK_MAX_REGRESSION, help='allowed throughput drop relative to the baseline')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    signing_context = create_test_signing_context()
+    results = {
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python_version': platform.python_version(),
+        'latency_ms': args.latency_ms,
+        'signing_workers': args.signing_workers,
+        'runs': [run_benchmark(rows_count, signing_context, args.latency_ms / 1000, args.seed, args.keep_rate_limits, args.signing_workers) for rows_count in args.sizes],
+    }
+    print_results(results)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results saved to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f'regression: {regression}')
+        if regressions:
+            sys.exit(1)
@@ -1,34 +1,70 @@
+import argparse
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import functools
 import hashlib
+import hmac
+import http.server
+import io
 import logging
+import operator
 import os
 import re
-import tempfile
+import signal
+import sqlite3
+import tarfile
+import threading
 import time
-import boto3
+import zipfile
 import json
 import dotenv
 import phonenumbers
-from gdolim import GoogleSheetsClient
-from botocore.exceptions import ClientError
+from googleapiclient.errors import HttpError
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from applepassgenerator.client import ApplePassGeneratorClient
-from applepassgenerator.models import Generic
 
 dotenv.load_dotenv()
 
 APPLE_CARD_TEAM_IDENTIFIER = "E85N35G3YB"
 APPLE_CARD_PASS_TYPE_IDENTIFIER = "pass.com.madappgang.doc.israel"
 APPLE_CARD_ORGANIZATION_NAME = "DOC Israel"
-APPLE_CARD_PKPASS_PRIVATE_KEY = os.environ['APPLE_CARD_PRIVATE_KEY']
-APPLE_CARD_PKPASS_PRIVATE_KEY = APPLE_CARD_PKPASS_PRIVATE_KEY.replace('\\n', '\n')
-APPLE_CARD_PKPASS_PRIVATE_KEY_PASSWORD = os.environ['APPLE_CARD_PRIVATE_KEY_PASSWORD']
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-
+RESOURCE_DIR_PATH = os.path.join(SCRIPT_DIR, 'resources')
+APPLE_CARD_RESOURCES = {
+    "logo.png": os.path.join('assets', 'doc.png'),
+    "logo@2x.png": os.path.join('assets', 'doc@2x.png'),
+    "logo@3x.png": os.path.join('assets', 'doc@3x.png'),
+    "icon.png": os.path.join('assets', 'doc_il.png'),
+    "thumbnail.png": os.path.join('assets', 'doc_il.png'),
+    "thumbnail@2x.png": os.path.join('assets', 'doc_il@2x.png'),
+    "thumbnail@3x.png": os.path.join('assets', 'doc_il@3x.png'),
+    "en.lproj/pass.strings": os.path.join('en.lproj', 'pass.strings'),
+    "he.lproj/pass.strings": os.path.join('he.lproj', 'pass.strings'),
+}
+APPLE_CARD_CERTIFICATE_FILE_PATH = os.path.join(RESOURCE_DIR_PATH, 'certs', 'certificate.pem')
+APPLE_CARD_WWDR_CERTIFICATE_FILE_PATH = os.path.join(RESOURCE_DIR_PATH, 'certs', 'wwdr.pem')
+
+HEADER_EMAIL_ADDRESS = 'כתובת אימייל'
+HEADER_PHONE_NUMBER = 'טלפון סלולרי'
+HEADER_MEMBERSHIP_YEAR = 'חברות'
+HEADER_DUCATI_MEMBER_CODE = 'קוד דוקאטי'
+HEADER_ROLE = 'תפקיד'
+HEADER_HEBREW_FULL_NAME = 'שם מלא בעברית'
+HEADER_ENGLISH_FULL_NAME = 'שם מלא באנגלית'
+HEADER_TAGS = 'אישור'
+HEADER_MOTORCYCLE_MODEL = 'דגם אופנוע נוכחי'
+HEADER_MEMBERSHIP_EXPIRATION = 'תפוגה'
+HEADER_REGISTRATION_TYPE = 'זוגי'
+HEADER_LEFT = 'עזב'
 HEADER_BOT_STATUS = 'סטטוס בוט'
 HEADER_LAST_RENEWAL_REMINDER_DATE = 'תאריך תזכורת חידוש אחרון'
+MEMBER_REQUIRED_HEADERS = [HEADER_EMAIL_ADDRESS, HEADER_PHONE_NUMBER, HEADER_MEMBERSHIP_YEAR, HEADER_DUCATI_MEMBER_CODE, HEADER_ROLE, HEADER_HEBREW_FULL_NAME, HEADER_ENGLISH_FULL_NAME,
+                           HEADER_TAGS, HEADER_MOTORCYCLE_MODEL, HEADER_MEMBERSHIP_EXPIRATION, HEADER_REGISTRATION_TYPE, HEADER_LEFT]
+MEMBER_PARSE_CACHE_SIZE = 16384  # bounds the memoised phone numbers, dates and vcard ids, a few times the number of members
 STATUS_UPDATE = 'עדכון'
 STATUS_UPDATE_TYPO = 'עידכון'
 STATUS_ISSUE = 'הנפקה'
@@ -41,27 +77,216 @@ EMAIL_ADDRESS_SENDER = "Ducati Israel <noreply@docil.co.il>"
 
 SMS_SENDER_ID = 'DOCIL'
 
-GOOGLE_SPREADSHEET_ID = os.environ['GOOGLE_SPREADSHEET_ID']
-GOOGLE_SERVICE_ACCOUNT_CREDENTIALS = os.environ['GOOGLE_SERVICE_ACCOUNT_CREDENTIALS']
-AWS_S3_BUCKET_NAME = os.environ['AWS_S3_BUCKET_NAME']
-AWS_ACCESS_KEY_ID = os.environ['AWS_ACCESS_KEY_ID']
-AWS_SECRET_ACCESS_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
-AWS_SNS_REGION = os.environ['AWS_SNS_REGION']
-AWS_SES_REGION = os.environ['AWS_SES_REGION']
-CONTACT_PHONE_NUMBER = os.environ['CONTACT_PHONE_NUMBER']
+RATE_LIMITS_PER_SECOND = {
+    'sheets': float(os.environ.get('RATE_LIMIT_SHEETS_PER_SECOND', 1)),
+    'ses': float(os.environ.get('RATE_LIMIT_SES_PER_SECOND', 14)),
+    'sns': float(os.environ.get('RATE_LIMIT_SNS_PER_SECOND', 20)),
+    's3': float(os.environ.get('RATE_LIMIT_S3_PER_SECOND', 100)),
+}
+RATE_LIMIT_MAX_THROTTLED_ATTEMPTS = 5
+RATE_LIMIT_THROTTLING_ERROR_CODES = ['Throttling', 'ThrottlingException', 'SlowDown', 'TooManyRequestsException', 'RequestLimitExceeded', 'MaxSendRateExceeded']
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', os.path.join(SCRIPT_DIR, 'state', 'state.sqlite3'))
+STATE_DB_SCHEMA_VERSION = 2  # the state database is a cache, it is recreated when the schema version changes
+STATE_DB_KEPT_TABLES = ['outbox']  # not a cache, kept when the schema version changes, so their schema must stay compatible
+CARD_CONTENT_HASH_VERSION = 1  # bump when the card layout, assets or certificates change so all cards are republished
+CARD_CONTENT_HASH_METADATA_KEY = 'content-hash'
+OUTBOX_STEP_SIGNED = 'signed'
+OUTBOX_STEP_UPLOADED = 'uploaded'
+OUTBOX_STEP_ISSUE_NOTIFIED = 'issue_notified'
+OUTBOX_STEP_RENEWAL_NOTIFIED = 'renewal_notified'
+OUTBOX_RETENTION_DAYS = 7  # steps of rows that were never completed, e.g. deleted from the sheet meanwhile
+FORCE_CARD_REPUBLISH = os.environ.get('FORCE_CARD_REPUBLISH', '').lower() in ['1', 'true', 'y']
+INCREMENTAL_SYNC = os.environ.get('INCREMENTAL_SYNC', '1').lower() in ['1', 'true', 'y']
+FORCE_FULL_RESCAN = os.environ.get('FORCE_FULL_RESCAN', '').lower() in ['1', 'true', 'y']
+FULL_RESCAN_INTERVAL_HOURS = int(os.environ.get('FULL_RESCAN_INTERVAL_HOURS', 24))
 
-RATE_LIMIT_SLEEP_INTERVAL_SECONDS = 5
 RENEWAL_NOTIFICATIONS_PERIOD_DAYS = 31
 RENEWAL_NOTIFICATIONS_TTL_DAYS = 15
-MAX_DOCUMENT_UPDATES = 25
-
-aws_session = boto3.Session(aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
-aws_s3_resource = aws_session.resource('s3')
-aws_ses_client = aws_session.client('ses', region_name=AWS_SES_REGION)
-aws_sns_client = aws_session.client('sns', region_name=AWS_SNS_REGION)
-
-google_service_account_credentials = json.loads(bytes.fromhex(GOOGLE_SERVICE_ACCOUNT_CREDENTIALS).decode())
-google_sheets_client = GoogleSheetsClient(google_service_account_credentials, GOOGLE_SPREADSHEET_ID)
+MAX_DOCUMENT_UPDATES = 200
+WORK_CLASS_ERROR = 'error'
+WORK_CLASS_ISSUE = 'issue'
+WORK_CLASS_REVOKE = 'revoke'
+WORK_CLASS_UPDATE = 'update'
+WORK_CLASS_RENEWAL = 'renewal'
+# the budget of document updates goes to the classes with the higher weight first
+WORK_PRIORITY_WEIGHTS = {
+    WORK_CLASS_ERROR: float(os.environ.get('WORK_PRIORITY_ERROR_WEIGHT', 5)),
+    WORK_CLASS_ISSUE: float(os.environ.get('WORK_PRIORITY_ISSUE_WEIGHT', 4)),
+    WORK_CLASS_REVOKE: float(os.environ.get('WORK_PRIORITY_REVOKE_WEIGHT', 3)),
+    WORK_CLASS_UPDATE: float(os.environ.get('WORK_PRIORITY_UPDATE_WEIGHT', 2)),
+    WORK_CLASS_RENEWAL: float(os.environ.get('WORK_PRIORITY_RENEWAL_WEIGHT', 1)),
+}
+# the share of the budget a class may take while other classes are waiting
+WORK_CLASS_QUOTAS = {
+    WORK_CLASS_ERROR: float(os.environ.get('WORK_QUOTA_ERROR', 0.25)),
+    WORK_CLASS_ISSUE: float(os.environ.get('WORK_QUOTA_ISSUE', 1)),
+    WORK_CLASS_REVOKE: float(os.environ.get('WORK_QUOTA_REVOKE', 0.5)),
+    WORK_CLASS_UPDATE: float(os.environ.get('WORK_QUOTA_UPDATE', 0.5)),
+    WORK_CLASS_RENEWAL: float(os.environ.get('WORK_QUOTA_RENEWAL', 0.5)),
+}
+SES_BULK_SENDING = os.environ.get('SES_BULK_SENDING', '1').lower() in ['1', 'true', 'y']
+SES_BULK_BATCH_SIZE = 50
+SES_TEMPLATE_NAME_PREFIX = 'docil'
+SHEET_WRITE_BUFFER_MAX_UPDATES = 50
+APPLE_CARD_SIGNING_WORKERS = int(os.environ.get('APPLE_CARD_SIGNING_WORKERS', 1))
+AWS_S3_MAX_CONCURRENT_UPLOADS = int(os.environ.get('AWS_S3_MAX_CONCURRENT_UPLOADS', 10))
+AWS_S3_MAX_IN_FLIGHT_UPLOADS = AWS_S3_MAX_CONCURRENT_UPLOADS * 3
+AWS_S3_MAX_PENDING_CARDS = 4
+AWS_S3_UPLOAD_MAX_ATTEMPTS = 4
+AWS_S3_UPLOAD_RETRY_BACKOFF_SECONDS = 0.5
+SHORT_LINK_OBJECTS = os.environ.get('SHORT_LINK_OBJECTS', '1').lower() in ['1', 'true', 'y']  # the per card short/{short_vcard_id}.json objects, until the frontend reads the index
+SHORT_LINK_INDEX_KEY_PREFIX = 'short_index'
+SHORT_LINK_INDEX_PREFIX_LENGTH = 2  # 256 shards
+SHORT_LINK_INDEX_CACHE_CONTROL = 'public, max-age=60'
+EXPORT_MAX_PENDING_CARDS = max(1, APPLE_CARD_SIGNING_WORKERS) * 4
+EXPORT_MULTIPART_CHUNK_SIZE = 64 * 1024 * 1024
+AWS_S3_TRANSIENT_ERROR_CODES = ['RequestTimeout', 'SlowDown', 'InternalError', 'ServiceUnavailable', 'Throttling']
+RUN_METRICS_PATH = os.environ.get('RUN_METRICS_PATH', os.path.join(SCRIPT_DIR, 'run_metrics.json'))
+RUN_METRICS_PROMETHEUS_PATH = os.environ.get('RUN_METRICS_PROMETHEUS_PATH')  # e.g. a node_exporter textfile collector .prom file
+RUN_METRICS_PROMETHEUS_PREFIX = 'vcard_sync'
+DAEMON_MIN_POLL_INTERVAL_SECONDS = float(os.environ.get('DAEMON_MIN_POLL_INTERVAL_SECONDS', 10))
+DAEMON_MAX_POLL_INTERVAL_SECONDS = float(os.environ.get('DAEMON_MAX_POLL_INTERVAL_SECONDS', 300))
+DAEMON_TRIGGER_HOST = os.environ.get('DAEMON_TRIGGER_HOST', '127.0.0.1')
+DAEMON_TRIGGER_PORT = int(os.environ.get('DAEMON_TRIGGER_PORT', 8080))
+DAEMON_TRIGGER_TOKEN = os.environ.get('DAEMON_TRIGGER_TOKEN')  # required in the X-Trigger-Token header of /sync when set
+
+
+class ServiceContainer:
+    # credentials and clients are read and created on first use, so importing this module needs neither secrets nor boto3.
+    # tests and benchmarks replace them by assigning the attributes
+    @functools.cached_property
+    def apple_card_private_key(self):
+        return os.environ['APPLE_CARD_PRIVATE_KEY'].replace('\\n', '\n')
+
+    @functools.cached_property
+    def apple_card_private_key_password(self):
+        return os.environ['APPLE_CARD_PRIVATE_KEY_PASSWORD']
+
+    @functools.cached_property
+    def aws_s3_bucket_name(self):
+        return os.environ['AWS_S3_BUCKET_NAME']
+
+    @functools.cached_property
+    def contact_phone_number(self):
+        return os.environ['CONTACT_PHONE_NUMBER']
+
+    @functools.cached_property
+    def aws_session(self):
+        import boto3
+        return boto3.Session(aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'], aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'])
+
+    @functools.cached_property
+    def aws_s3_resource(self):
+        from botocore.config import Config
+        return self.aws_session.resource('s3', config=Config(max_pool_connections=AWS_S3_MAX_CONCURRENT_UPLOADS, retries={'mode': 'standard'}))
+
+    @functools.cached_property
+    def aws_s3_publisher_client(self):
+        # S3Publisher retries uploads itself, with backoff through the s3 rate limiter, so botocore's retries are off
+        from botocore.config import Config
+        return self.aws_session.client('s3', config=Config(max_pool_connections=AWS_S3_MAX_CONCURRENT_UPLOADS, retries={'mode': 'standard', 'total_max_attempts': 1}))
+
+    @functools.cached_property
+    def aws_ses_client(self):
+        return self.aws_session.client('ses', region_name=os.environ['AWS_SES_REGION'])
+
+    @functools.cached_property
+    def aws_sns_client(self):
+        return self.aws_session.client('sns', region_name=os.environ['AWS_SNS_REGION'])
+
+    @functools.cached_property
+    def google_sheets_client(self):
+        from gdolim import GoogleSheetsClient
+        google_service_account_credentials = json.loads(bytes.fromhex(os.environ['GOOGLE_SERVICE_ACCOUNT_CREDENTIALS']).decode())
+        return GoogleSheetsClient(google_service_account_credentials, os.environ['GOOGLE_SPREADSHEET_ID'])
+
+
+services = ServiceContainer()
+
+
+class RunMetrics:
+    # durations of the stages of a run and counters of what it did, summarized at the end of the run.
+    # stages are recorded from the s3 publisher threads too
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.started_at = datetime.datetime.now()
+            self.durations = collections.defaultdict(list)
+            self.counters = collections.Counter()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.durations[stage].append(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def increment(self, counter, count=1):
+        with self.lock:
+            self.counters[counter] += count
+
+    def summary(self):
+        with self.lock:
+            durations = {stage: sorted(stage_durations) for stage, stage_durations in self.durations.items()}
+            counters = dict(self.counters)
+        return {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'counters': dict(sorted(counters.items())),
+            'stages': {stage: {
+                'count': len(stage_durations),
+                'total_seconds': round(sum(stage_durations), 6),
+                'p50_seconds': round(_percentile(stage_durations, 50), 6),
+                'p95_seconds': round(_percentile(stage_durations, 95), 6),
+                'max_seconds': round(stage_durations[-1], 6),
+            } for stage, stage_durations in sorted(durations.items())},
+        }
+
+
+def _percentile(sorted_values, percent):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+def format_prometheus_metrics(summary, prefix=RUN_METRICS_PROMETHEUS_PREFIX):
+    lines = [
+        f'# HELP {prefix}_stage_duration_seconds duration of the stages of the last sync run',
+        f'# TYPE {prefix}_stage_duration_seconds summary',
+    ]
+    for stage, stage_summary in summary['stages'].items():
+        lines.append(f'{prefix}_stage_duration_seconds{{stage="{stage}",quantile="0.5"}} {stage_summary["p50_seconds"]}')
+        lines.append(f'{prefix}_stage_duration_seconds{{stage="{stage}",quantile="0.95"}} {stage_summary["p95_seconds"]}')
+        lines.append(f'{prefix}_stage_duration_seconds_sum{{stage="{stage}"}} {stage_summary["total_seconds"]}')
+        lines.append(f'{prefix}_stage_duration_seconds_count{{stage="{stage}"}} {stage_summary["count"]}')
+    lines.append(f'# HELP {prefix}_events number of rows, cards, notifications and errors of the last sync run')
+    lines.append(f'# TYPE {prefix}_events gauge')
+    for counter, count in summary['counters'].items():
+        lines.append(f'{prefix}_events{{event="{counter}"}} {count}')
+    lines.append(f'# TYPE {prefix}_last_run_timestamp_seconds gauge')
+    lines.append(f'{prefix}_last_run_timestamp_seconds {datetime.datetime.fromisoformat(summary["started_at"]).timestamp():.0f}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_run_metrics(summary, json_path=RUN_METRICS_PATH, prometheus_path=RUN_METRICS_PROMETHEUS_PATH):
+    # written to a temporary file first, so a collector never reads a partial file
+    outputs = [(json_path, json.dumps(summary, indent=2))]
+    if prometheus_path:
+        outputs.append((prometheus_path, format_prometheus_metrics(summary)))
+    for path, content in outputs:
+        if not path:
+            continue
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(content)
+        os.replace(f'{path}.tmp', path)
+
+
+run_metrics = RunMetrics()
 
 
 def normalize_phone_number(phone_number, default_country_code="IL"):
@@ -77,15 +302,82 @@ def normalize_email_address(email_address):
     return email_address.lower().strip()
 
 
+class RateLimiter:
+    # token bucket that adapts to the service: its rate is halved whenever the service throttles us
+    # and grows back towards the configured rate as calls succeed
+    def __init__(self, name, rate_per_second, burst=None, min_rate_per_second=None, max_throttled_attempts=RATE_LIMIT_MAX_THROTTLED_ATTEMPTS, clock=time.monotonic, sleep=time.sleep):
+        self.name = name
+        self.max_rate_per_second = rate_per_second
+        self.min_rate_per_second = min_rate_per_second or rate_per_second / 16
+        self.rate_per_second = rate_per_second
+        self.burst = burst or max(1.0, rate_per_second)
+        self.max_throttled_attempts = max_throttled_attempts
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.burst
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate_per_second)
+            self.updated_at = now
+            self.tokens -= tokens
+            wait_seconds = -self.tokens / self.rate_per_second if self.tokens < 0 else 0
+
+        if wait_seconds:
+            with run_metrics.timed(f'rate_limit_sleep.{self.name}'):
+                self.sleep(wait_seconds)
+
+    def on_success(self):
+        with self.lock:
+            self.rate_per_second = min(self.max_rate_per_second, self.rate_per_second + self.max_rate_per_second / 10)
+
+    def on_throttled(self):
+        with self.lock:
+            self.rate_per_second = max(self.min_rate_per_second, self.rate_per_second / 2)
+            self.tokens = min(self.tokens, 0)
+        logging.warning(f'{self.name} is throttling requests, slowing down to {self.rate_per_second:.2f} requests per second')
+
+    def call(self, func, *args, tokens=1, **kwargs):
+        attempt = 1
+        while True:
+            self.acquire(tokens)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_throttling_error(e):
+                    raise
+                self.on_throttled()
+                if attempt >= self.max_throttled_attempts:
+                    raise
+                attempt += 1
+            else:
+                self.on_success()
+                return result
+
+
+def is_throttling_error(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in RATE_LIMIT_THROTTLING_ERROR_CODES
+    if isinstance(error, HttpError):
+        return error.resp.status == 429
+    return False
+
+
+rate_limiters = {name: RateLimiter(name, rate_per_second) for name, rate_per_second in RATE_LIMITS_PER_SECOND.items()}
+
+
 def send_sms(phone_number, sms_message, sender_id=SMS_SENDER_ID):
     return # disabled
     number = normalize_phone_number(phone_number)
-    aws_sns_client.publish(PhoneNumber=number, Message=sms_message, MessageAttributes={'AWS.SNS.SMS.SenderID': {'DataType': 'String', 'StringValue': sender_id}, 'AWS.SNS.SMS.SMSType': {'DataType': 'String', 'StringValue': 'Transactional'}})
+    with run_metrics.timed('send_sms'):
+        rate_limiters['sns'].call(services.aws_sns_client.publish, PhoneNumber=number, Message=sms_message, MessageAttributes={'AWS.SNS.SMS.SenderID': {'DataType': 'String', 'StringValue': sender_id}, 'AWS.SNS.SMS.SMSType': {'DataType': 'String', 'StringValue': 'Transactional'}})
 
 
 def send_email(email_subject, email_text, recipient_email_address, sender_email_address=EMAIL_ADDRESS_SENDER, reply_to_email_address=None):
-    email_text_html = email_text.replace('\n', '<br>')
-    email_text_html = f'<html><head></head><body><p dir="rtl">{email_text_html}</p></body></html>'
+    email_text_html = _render_email_html(email_text)
 
     email_message = MIMEMultipart('mixed')
     email_message['Subject'] = email_subject
@@ -107,19 +399,654 @@ def send_email(email_subject, email_text, recipient_email_address, sender_email_
     email_message.add_header('Cache - Control', 'post - check = 0, pre - check = 0')
     email_message.add_header('Pragma', 'no-cache')
     try:
-        aws_ses_client.send_raw_email(
-            Source=sender_email_address,
-            Destinations=[recipient_email_address],
-            RawMessage={
-                'Data': email_message.as_string(),
-            }
-        )
+        with run_metrics.timed('send_email'):
+            rate_limiters['ses'].call(
+                services.aws_ses_client.send_raw_email,
+                Source=sender_email_address,
+                Destinations=[recipient_email_address],
+                RawMessage={
+                    'Data': email_message.as_string(),
+                }
+            )
 
     except ClientError:
         logging.exception('could not send email')
 
 
-def create_apple_wallet_card(vcard_info):
+class ApplePassSigningContext:
+    # holds everything a .pkpass needs besides its pass.json, so it is built once per process
+    # and every card only hashes and signs its own pass.json
+    def __init__(self, certificate, private_key, wwdr_certificate, resource_files):
+        self.certificate = certificate
+        self.private_key = private_key
+        self.wwdr_certificate = wwdr_certificate
+        self.resource_files = dict(resource_files)
+        self.resource_hashes = {resource_name: hashlib.sha1(resource_data).hexdigest() for resource_name, resource_data in self.resource_files.items()}
+
+    @classmethod
+    def load(cls, private_key_pem, private_key_password, certificate_file_path=APPLE_CARD_CERTIFICATE_FILE_PATH, wwdr_certificate_file_path=APPLE_CARD_WWDR_CERTIFICATE_FILE_PATH, resource_dir_path=RESOURCE_DIR_PATH, resources=None):
+        from cryptography import x509
+        from cryptography.hazmat.primitives import serialization
+
+        resources = APPLE_CARD_RESOURCES if resources is None else resources
+        resource_files = {}
+        for resource_name, resource_file_path in resources.items():
+            with open(os.path.join(resource_dir_path, resource_file_path), 'rb') as f:
+                resource_files[resource_name] = f.read()
+
+        with open(certificate_file_path, 'rb') as f:
+            certificate = x509.load_pem_x509_certificate(f.read())
+
+        with open(wwdr_certificate_file_path, 'rb') as f:
+            wwdr_certificate = x509.load_pem_x509_certificate(f.read())
+
+        private_key = serialization.load_pem_private_key(private_key_pem.encode(), password=private_key_password.encode())
+        return cls(certificate, private_key, wwdr_certificate, resource_files)
+
+    def sign(self, apple_pass):
+        from applepassgenerator.models import pass_handler
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.serialization import pkcs7
+
+        pass_json = json.dumps(apple_pass, default=pass_handler)
+        manifest_hashes = {'pass.json': hashlib.sha1(pass_json.encode('utf-8')).hexdigest()}
+        manifest_hashes.update(self.resource_hashes)
+        manifest = json.dumps(manifest_hashes)
+
+        signature = pkcs7.PKCS7SignatureBuilder() \
+            .set_data(manifest.encode('utf-8')) \
+            .add_signer(self.certificate, self.private_key, hashes.SHA1()) \
+            .add_certificate(self.wwdr_certificate) \
+            .sign(serialization.Encoding.DER, [pkcs7.PKCS7Options.DetachedSignature])
+
+        apple_card = io.BytesIO()
+        with zipfile.ZipFile(apple_card, 'w') as zf:
+            zf.writestr('signature', signature)
+            zf.writestr('manifest.json', manifest)
+            zf.writestr('pass.json', pass_json)
+            for resource_name, resource_data in self.resource_files.items():
+                zf.writestr(resource_name, resource_data)
+
+        return apple_card.getvalue()
+
+
+_apple_pass_signing_context = None
+
+
+def get_apple_pass_signing_context():
+    global _apple_pass_signing_context
+    if _apple_pass_signing_context is None:
+        _apple_pass_signing_context = ApplePassSigningContext.load(services.apple_card_private_key, services.apple_card_private_key_password)
+    return _apple_pass_signing_context
+
+
+_apple_card_signing_executor = None  # kept for the lifetime of the daemon, a pool per sync otherwise
+
+
+def create_apple_card_signing_executor():
+    # the signing context is loaded in the parent first, so the forked workers inherit it instead of each decrypting
+    # the key and reading the assets again
+    get_apple_pass_signing_context()
+    return concurrent.futures.ProcessPoolExecutor(max_workers=APPLE_CARD_SIGNING_WORKERS, initializer=get_apple_pass_signing_context)
+
+
+def get_card_object_keys(vcard_id, short_vcard_id=None):
+    card_object_keys = [f'card/{vcard_id}.json', f'apple_card/{vcard_id}.pkpass']
+    if SHORT_LINK_OBJECTS and short_vcard_id:
+        card_object_keys.append(f'short/{short_vcard_id}.json')
+    return card_object_keys
+
+
+def compute_card_content_hash(vcard_info):
+    vcard_info_json = json.dumps([CARD_CONTENT_HASH_VERSION, vcard_info], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(vcard_info_json.encode('utf-8')).hexdigest()
+
+
+class CardStateStore:
+    # remembers the content hash of every published card in a local sqlite database.
+    # the hash is also stored as metadata of every object of the card on s3, which is used when the local database
+    # doesn't know the card (e.g. a fresh checkout)
+    def __init__(self, db, s3_client=None, bucket_name=None):
+        self.db = db
+        self.db.execute('CREATE TABLE IF NOT EXISTS card_content_hashes (vcard_id TEXT PRIMARY KEY, content_hash TEXT NOT NULL, updated_at TEXT NOT NULL)')
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+
+    def get_content_hash(self, vcard_id, card_object_keys=None):
+        row = self.db.execute('SELECT content_hash FROM card_content_hashes WHERE vcard_id = ?', (vcard_id,)).fetchone()
+        if row:
+            return row[0]
+
+        if not self.s3_client:
+            return None
+
+        # the objects of a card are uploaded independently, so the card is only published if all of them carry its hash
+        content_hashes = set()
+        for key in card_object_keys or get_card_object_keys(vcard_id):
+            try:
+                response = rate_limiters['s3'].call(self.s3_client.head_object, Bucket=self.bucket_name, Key=key)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in ['404', 'NoSuchKey', 'NotFound']:
+                    # e.g. 403 for missing keys without s3:ListBucket, the card is republished
+                    logging.warning(f'failed looking up the content hash of "{key}", republishing the card', exc_info=True)
+                return None
+            except Exception:
+                logging.warning(f'failed looking up the content hash of "{key}", republishing the card', exc_info=True)
+                return None
+            content_hashes.add(response.get('Metadata', {}).get(CARD_CONTENT_HASH_METADATA_KEY))
+
+        if len(content_hashes) != 1 or None in content_hashes:
+            return None
+        content_hash, = content_hashes
+        self.set_content_hash(vcard_id, content_hash)
+        return content_hash
+
+    def get_vcard_ids(self):
+        return {vcard_id for vcard_id, in self.db.execute('SELECT vcard_id FROM card_content_hashes')}
+
+    def set_content_hash(self, vcard_id, content_hash):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO card_content_hashes (vcard_id, content_hash, updated_at) VALUES (?, ?, ?)', (vcard_id, content_hash, datetime.datetime.now().isoformat()))
+
+
+def compute_item_fingerprint(item):
+    item_values = '\x1f'.join(str(value) for field_name, value in item.items() if field_name != 'id')
+    return hashlib.sha1(item_values.encode('utf-8')).hexdigest()
+
+
+class RowSnapshotStore:
+    # fingerprints of the sheet rows that had no pending work, keyed by vcard id
+    def __init__(self, db):
+        self.db = db
+        self.db.execute('CREATE TABLE IF NOT EXISTS row_fingerprints (vcard_id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.fingerprints = {fingerprint for fingerprint, in self.db.execute('SELECT fingerprint FROM row_fingerprints')}
+        self.pending_rows = {}
+
+    def is_unchanged(self, fingerprint):
+        return fingerprint in self.fingerprints
+
+    def add(self, vcard_id, fingerprint):
+        self.pending_rows[vcard_id] = fingerprint
+
+    def commit(self):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO row_fingerprints (vcard_id, fingerprint) VALUES (?, ?)', self.pending_rows.items())
+        self.fingerprints.update(self.pending_rows.values())
+        self.pending_rows.clear()
+
+    def is_full_rescan_due(self, now, interval_hours):
+        row = self.db.execute("SELECT value FROM sync_state WHERE key = 'last_full_rescan'").fetchone()
+        return not row or now - datetime.datetime.fromisoformat(row[0]) >= datetime.timedelta(hours=interval_hours)
+
+    def set_last_full_rescan(self, now):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES ('last_full_rescan', ?)", (now.isoformat(),))
+
+
+class RenewalIndex:
+    # the members that will need a renewal reminder, ordered by the date their next reminder is due
+    def __init__(self, db):
+        self.db = db
+        self.db.execute('CREATE TABLE IF NOT EXISTS renewal_index (vcard_id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, membership_expiration TEXT NOT NULL, last_renewal_reminder_date TEXT NOT NULL, next_reminder_date TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS renewal_index_next_reminder_date ON renewal_index (next_reminder_date)')
+
+    def update(self, member, fingerprint):
+        next_reminder_date = get_next_renewal_reminder_date(member)
+        if next_reminder_date is None:
+            self.db.execute('DELETE FROM renewal_index WHERE vcard_id = ?', (member.vcard_id,))
+            return
+
+        self.db.execute('INSERT OR REPLACE INTO renewal_index (vcard_id, fingerprint, membership_expiration, last_renewal_reminder_date, next_reminder_date) VALUES (?, ?, ?, ?, ?)',
+                        (member.vcard_id, fingerprint, member.membership_expiration.isoformat(), member.last_renewal_reminder_date.isoformat(), next_reminder_date.isoformat()))
+
+    def remove(self, vcard_id):
+        self.db.execute('DELETE FROM renewal_index WHERE vcard_id = ?', (vcard_id,))
+
+    def retain(self, vcard_ids):
+        stale_vcard_ids = [(vcard_id,) for vcard_id, in self.db.execute('SELECT vcard_id FROM renewal_index') if vcard_id not in vcard_ids]
+        self.db.executemany('DELETE FROM renewal_index WHERE vcard_id = ?', stale_vcard_ids)
+
+    def is_empty(self):
+        return self.db.execute('SELECT 1 FROM renewal_index LIMIT 1').fetchone() is None
+
+    def get_due(self, now):
+        return self.db.execute('SELECT vcard_id, fingerprint FROM renewal_index WHERE next_reminder_date <= ? ORDER BY next_reminder_date', (now.isoformat(),)).fetchall()
+
+    def get_upcoming(self, now, days):
+        # the reminders that will be sent in the next days, assuming nobody renews in the meantime
+        until = now + datetime.timedelta(days=days)
+        reminders = []
+        for vcard_id, membership_expiration, next_reminder_date in self.db.execute('SELECT vcard_id, membership_expiration, next_reminder_date FROM renewal_index WHERE next_reminder_date <= ? ORDER BY next_reminder_date', (until.isoformat(),)):
+            membership_expiration = datetime.datetime.fromisoformat(membership_expiration)
+            reminder_date = max(now, datetime.datetime.fromisoformat(next_reminder_date))
+            while reminder_date <= min(until, membership_expiration):
+                reminders.append((reminder_date, vcard_id))
+                reminder_date += datetime.timedelta(days=RENEWAL_NOTIFICATIONS_TTL_DAYS)
+        return sorted(reminders)
+
+
+class OutboxJournal:
+    # the steps done for each row of the current run, each committed as soon as it is done, so a run that was cancelled
+    # or crashed is resumed by the next one without signing, uploading or notifying again.
+    # the steps of a card are only reused while its content hash is the same. notifications are recorded before they
+    # are sent, so they are sent at most once. the steps of a row are removed once its sheet update is written
+    def __init__(self, db):
+        self.db = db
+        self.db.execute('CREATE TABLE IF NOT EXISTS outbox (vcard_id TEXT NOT NULL, step TEXT NOT NULL, content_hash TEXT, payload BLOB, recorded_at TEXT NOT NULL, PRIMARY KEY (vcard_id, step))')
+        with self.db:
+            self.db.execute('DELETE FROM outbox WHERE recorded_at < ?', ((datetime.datetime.now() - datetime.timedelta(days=OUTBOX_RETENTION_DAYS)).isoformat(),))
+        self.steps = collections.defaultdict(dict)
+        for vcard_id, step, content_hash in self.db.execute('SELECT vcard_id, step, content_hash FROM outbox'):
+            self.steps[vcard_id][step] = content_hash
+        self.completed_vcard_ids = set()
+        if self.steps:
+            logging.info(f'resuming {len(self.steps)} rows interrupted by the previous run')
+
+    def has_step(self, vcard_id, step, content_hash=None):
+        steps = self.steps.get(vcard_id, {})
+        return step in steps and steps[step] == content_hash
+
+    def get_payload(self, vcard_id, step, content_hash=None):
+        if not self.has_step(vcard_id, step, content_hash):
+            return None
+        payload, = self.db.execute('SELECT payload FROM outbox WHERE vcard_id = ? AND step = ?', (vcard_id, step)).fetchone()
+        return payload
+
+    def record(self, vcard_id, steps, content_hash=None, payload=None):
+        recorded_at = datetime.datetime.now().isoformat()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO outbox (vcard_id, step, content_hash, payload, recorded_at) VALUES (?, ?, ?, ?, ?)',
+                                [(vcard_id, step, content_hash, payload, recorded_at) for step in steps])
+        self.steps[vcard_id].update((step, content_hash) for step in steps)
+
+    def complete(self, vcard_id):
+        # the row is done once the sheet updates buffered right after are written, see flush_completed
+        self.completed_vcard_ids.add(vcard_id)
+
+    def flush_completed(self):
+        with self.db:
+            self.db.executemany('DELETE FROM outbox WHERE vcard_id = ?', [(vcard_id,) for vcard_id in self.completed_vcard_ids])
+        for vcard_id in self.completed_vcard_ids:
+            self.steps.pop(vcard_id, None)
+        self.completed_vcard_ids.clear()
+
+
+class ShortLinkIndex:
+    # maps short vcard ids to vcard ids in json shards on s3, short_index/{first characters of the short id}.json,
+    # so the frontend resolves a short link with one cacheable GET. the shards are kept in the state database and
+    # only the changed ones are uploaded. a shard the database doesn't have yet (e.g. a fresh checkout) is read from s3 first,
+    # and is not uploaded until it could be read, so the links already on s3 are never dropped
+    def __init__(self, db, s3_client, bucket_name, prefix_length=SHORT_LINK_INDEX_PREFIX_LENGTH):
+        self.db = db
+        self.db.execute('CREATE TABLE IF NOT EXISTS short_links (short_vcard_id TEXT PRIMARY KEY, vcard_id TEXT NOT NULL, shard TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS short_links_shard ON short_links (shard)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS short_link_shards (shard TEXT PRIMARY KEY, changed INTEGER NOT NULL)')
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.prefix_length = prefix_length
+        self.loaded_shards = set()
+        self.changed_shards = set()
+        self.failed_shards = set()
+        for shard, changed in self.db.execute('SELECT shard, changed FROM short_link_shards'):
+            self.loaded_shards.add(shard)
+            if changed:
+                # left over by a run that failed to upload it
+                self.changed_shards.add(shard)
+        for shard, in self.db.execute('SELECT DISTINCT shard FROM short_links WHERE shard NOT IN (SELECT shard FROM short_link_shards)'):
+            # left over by a run that failed to read it
+            self.changed_shards.add(shard)
+
+    def add(self, short_vcard_id, vcard_id):
+        shard = short_vcard_id[:self.prefix_length]
+        if shard not in self.failed_shards:
+            self._load_shard(shard)
+        row = self.db.execute('SELECT vcard_id FROM short_links WHERE short_vcard_id = ?', (short_vcard_id,)).fetchone()
+        if row and row[0] == vcard_id:
+            return
+
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO short_links (short_vcard_id, vcard_id, shard) VALUES (?, ?, ?)', (short_vcard_id, vcard_id, shard))
+            self.db.execute('UPDATE short_link_shards SET changed = 1 WHERE shard = ?', (shard,))
+        self.changed_shards.add(shard)
+
+    def flush(self):
+        for shard in sorted(self.changed_shards):
+            if not self._load_shard(shard):
+                continue
+            short_links = dict(self.db.execute('SELECT short_vcard_id, vcard_id FROM short_links WHERE shard = ? ORDER BY short_vcard_id', (shard,)))
+            try:
+                with run_metrics.timed('short_link_index_put'):
+                    rate_limiters['s3'].call(self.s3_client.put_object, Body=json.dumps(short_links).encode('utf-8'), Bucket=self.bucket_name, Key=self._get_shard_key(shard),
+                                             ACL='public-read', ContentType='application/json', CacheControl=SHORT_LINK_INDEX_CACHE_CONTROL)
+            except Exception:
+                # runs before every sheet flush, a failed upload must never keep the row statuses from being written
+                logging.exception(f'could not upload short link index shard "{shard}", retrying on the next flush')
+                continue
+            with self.db:
+                self.db.execute('UPDATE short_link_shards SET changed = 0 WHERE shard = ?', (shard,))
+            self.changed_shards.discard(shard)
+            logging.info(f'uploaded short link index shard "{shard}" ({len(short_links)} links)')
+
+    def _load_shard(self, shard):
+        if shard in self.loaded_shards:
+            return True
+
+        try:
+            response = rate_limiters['s3'].call(self.s3_client.get_object, Bucket=self.bucket_name, Key=self._get_shard_key(shard))
+            short_links = json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ['404', 'NoSuchKey', 'NotFound']:
+                return self._on_load_shard_failed(shard)
+            short_links = {}
+        except Exception:
+            return self._on_load_shard_failed(shard)
+
+        # links added while the shard couldn't be read are kept over the ones on s3, and uploaded
+        changed = self.db.execute('SELECT 1 FROM short_links WHERE shard = ? LIMIT 1', (shard,)).fetchone() is not None
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO short_links (short_vcard_id, vcard_id, shard) VALUES (?, ?, ?)', [(short_vcard_id, vcard_id, shard) for short_vcard_id, vcard_id in short_links.items()])
+            self.db.execute('INSERT OR REPLACE INTO short_link_shards (shard, changed) VALUES (?, ?)', (shard, int(changed)))
+        self.loaded_shards.add(shard)
+        self.failed_shards.discard(shard)
+        if changed:
+            self.changed_shards.add(shard)
+        return True
+
+    def _on_load_shard_failed(self, shard):
+        logging.warning(f'could not read short link index shard "{shard}", retrying on the next flush', exc_info=True)
+        self.failed_shards.add(shard)
+        return False
+
+    def list_short_link_objects(self):
+        # the short ids of the short/{short_vcard_id}.json objects, which predate the index
+        short_vcard_ids = set()
+        try:
+            for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix='short/'):
+                rate_limiters['s3'].acquire()
+                for s3_object in page.get('Contents', []):
+                    short_vcard_ids.add(s3_object['Key'][len('short/'):-len('.json')])
+        except Exception:
+            # e.g. without s3:ListBucket, only the cards of the state database are backfilled
+            logging.warning('could not list the short link objects', exc_info=True)
+        return short_vcard_ids
+
+    def _get_shard_key(self, shard):
+        return f'{SHORT_LINK_INDEX_KEY_PREFIX}/{shard}.json'
+
+
+def get_next_renewal_reminder_date(member):
+    # the earliest date on which _is_renewal_notification_due may become true, or None if it never will
+    if member.revoked:
+        return None
+
+    next_reminder_date = max(member.membership_expiration - datetime.timedelta(days=RENEWAL_NOTIFICATIONS_PERIOD_DAYS + 1), member.last_renewal_reminder_date + datetime.timedelta(days=RENEWAL_NOTIFICATIONS_TTL_DAYS))
+    if next_reminder_date > member.membership_expiration:
+        return None
+    return next_reminder_date
+
+
+def open_state_db(db_path):
+    if db_path != ':memory:':
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    db = sqlite3.connect(db_path)
+    # the outbox journal commits after every step, a write ahead log makes that cheap and survives the process being killed
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    schema_version, = db.execute('PRAGMA user_version').fetchone()
+    if schema_version != STATE_DB_SCHEMA_VERSION:
+        with db:
+            for table_name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+                if table_name not in STATE_DB_KEPT_TABLES:
+                    db.execute(f'DROP TABLE "{table_name}"')
+            db.execute(f'PRAGMA user_version = {STATE_DB_SCHEMA_VERSION}')
+    return db
+
+
+class S3Publisher:
+    # uploads objects from a thread pool sharing one client (and its connection pool), retrying transient failures.
+    # put_object blocks once max_in_flight uploads are queued or running
+    def __init__(self, s3_client, bucket_name, max_concurrent_uploads=AWS_S3_MAX_CONCURRENT_UPLOADS, max_in_flight=AWS_S3_MAX_IN_FLIGHT_UPLOADS, max_attempts=AWS_S3_UPLOAD_MAX_ATTEMPTS, retry_backoff_seconds=AWS_S3_UPLOAD_RETRY_BACKOFF_SECONDS, rate_limiter=None):
+        self.s3_client = s3_client
+        self.rate_limiter = rate_limiter or rate_limiters['s3']
+        self.bucket_name = bucket_name
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_uploads, thread_name_prefix='s3-publisher')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def put_object(self, key, body, metadata=None):
+        self.in_flight.acquire()
+        try:
+            future = self.executor.submit(self._put_object, key, body, metadata)
+        except:
+            self.in_flight.release()
+            raise
+        future.add_done_callback(lambda _: self.in_flight.release())
+        return future
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _put_object(self, key, body, metadata):
+        extra_args = {'Metadata': metadata} if metadata else {}
+        attempt = 1
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                with run_metrics.timed('s3_put'):
+                    result = self.s3_client.put_object(Body=body, Bucket=self.bucket_name, Key=key, ACL='public-read', **extra_args)
+                self.rate_limiter.on_success()
+                return result
+            except (ClientError, HTTPClientError, BotocoreConnectionError) as e:
+                # e.g. EndpointConnectionError and ConnectTimeoutError are connection errors, not http client errors
+                if is_throttling_error(e):
+                    self.rate_limiter.on_throttled()
+                if attempt >= self.max_attempts or not _is_transient_s3_error(e):
+                    raise
+                logging.warning(f'retrying upload of "{key}" (attempt {attempt}): {e}')
+                with run_metrics.timed('s3_retry_sleep'):
+                    time.sleep(self.retry_backoff_seconds * 2 ** (attempt - 1))
+                attempt += 1
+
+
+def _is_transient_s3_error(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in AWS_S3_TRANSIENT_ERROR_CODES or error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    return True
+
+
+class SheetWriteBuffer:
+    # collects cell updates during a run and writes them to the sheet with a single batchUpdate call.
+    # flushed when max_pending_updates is reached, and on exit, including when the run crashes
+    def __init__(self, sheets_client, max_pending_updates=SHEET_WRITE_BUFFER_MAX_UPDATES, rate_limiter=None):
+        self.sheets_client = sheets_client
+        self.max_pending_updates = max_pending_updates
+        self.rate_limiter = rate_limiter or rate_limiters['sheets']
+        self.before_flush = None
+        self.after_flush = None
+        self.pending_updates = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def set_item_field(self, item, field_name, value):
+        self.set_item_fields(item, {field_name: value})
+
+    def set_item_fields(self, item, values):
+        # the fields are buffered together, so a flush writes all of them or none
+        with run_metrics.timed('set_item_field'):
+            for field_name, value in values.items():
+                item[field_name] = value
+                self.pending_updates[(item['id'], field_name)] = value
+        if len(self.pending_updates) >= self.max_pending_updates:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_updates:
+            return
+
+        if self.before_flush:
+            self.before_flush()
+
+        with run_metrics.timed('sheet_flush'):
+            self._write_pending_updates()
+
+        if self.after_flush:
+            self.after_flush()
+
+    def _write_pending_updates(self):
+        for _, field_name in self.pending_updates:
+            if field_name not in self.sheets_client.headers:
+                self.rate_limiter.call(self.sheets_client.add_header, field_name)
+
+        import xlsxwriter.utility
+        data = []
+        for (item_id, field_name), value in self.pending_updates.items():
+            column_letter = xlsxwriter.utility.xl_col_to_name(self.sheets_client.headers.index(field_name))
+            row = item_id + 1  # the headers are the first row
+            data.append({
+                "range": f'{self.sheets_client.spreadsheet_name}!{column_letter}{row}',
+                "majorDimension": "ROWS",
+                "values": [[value]],
+            })
+
+        request = self.sheets_client.google_sheets_resource.spreadsheets().values().batchUpdate(
+            spreadsheetId=self.sheets_client.spreadsheet_id,
+            body={
+                "valueInputOption": "USER_ENTERED",
+                "data": data,
+            }
+        )
+        self.rate_limiter.call(request.execute)
+        logging.info(f'flushed {len(data)} sheet updates')
+        self.pending_updates.clear()
+
+
+def _exit_on_signal(signum, frame):
+    raise SystemExit(f'terminated by signal {signum}')
+
+
+def _render_email_html(email_text):
+    email_text_html = email_text.replace('\n', '<br>')
+    return f'<html><head></head><body><p dir="rtl">{email_text_html}</p></body></html>'
+
+
+def compile_template(template):
+    # splits the template once into its literal parts and {{placeholders}}, so rendering is a single join
+    template_parts = re.split(r'{{(\w+)}}', template)
+    literal_parts = template_parts[0::2]
+    placeholder_names = template_parts[1::2]
+
+    def render(template_data):
+        rendered_parts = [None] * len(template_parts)
+        rendered_parts[0::2] = literal_parts
+        rendered_parts[1::2] = [template_data[placeholder_name] for placeholder_name in placeholder_names]
+        return ''.join(rendered_parts)
+
+    render.template = template
+    render.placeholder_names = placeholder_names
+    return render
+
+
+def send_templated_email(template_name, template_data, recipient_email_address, email_sender=None):
+    if email_sender:
+        email_sender.send(template_name, template_data, recipient_email_address)
+        return
+
+    email_subject, render_email_text = compiled_email_templates[template_name]
+    send_email(email_subject, render_email_text(template_data), recipient_email_address)
+
+
+class BulkEmailSender:
+    # queues templated emails per template and sends them in batches with ses stored templates and SendBulkTemplatedEmail.
+    # recipients of a batch that could not be sent this way fall back to a raw email each
+    def __init__(self, ses_client, sender_email_address=EMAIL_ADDRESS_SENDER, batch_size=SES_BULK_BATCH_SIZE, rate_limiter=None):
+        self.ses_client = ses_client
+        self.sender_email_address = sender_email_address
+        self.batch_size = batch_size
+        self.rate_limiter = rate_limiter or rate_limiters['ses']
+        self.pending_emails = collections.defaultdict(list)
+        self.ses_template_names = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def send(self, template_name, template_data, recipient_email_address):
+        self.pending_emails[template_name].append((recipient_email_address, template_data))
+        if len(self.pending_emails[template_name]) >= self.batch_size:
+            self._send_batch(template_name)
+
+    def flush(self):
+        for template_name in list(self.pending_emails):
+            self._send_batch(template_name)
+
+    def _send_batch(self, template_name):
+        recipients = self.pending_emails.pop(template_name, [])
+        if not recipients:
+            return
+
+        failed_recipients = recipients
+        ses_template_name = self._get_ses_template_name(template_name)
+        if ses_template_name:
+            _, render_email_text = compiled_email_templates[template_name]
+            try:
+                with run_metrics.timed('send_bulk_templated_email'):
+                    response = self.rate_limiter.call(
+                        self.ses_client.send_bulk_templated_email,
+                        tokens=len(recipients),
+                        Source=self.sender_email_address,
+                        Template=ses_template_name,
+                        DefaultTemplateData=json.dumps({placeholder_name: '' for placeholder_name in render_email_text.placeholder_names}),
+                        Destinations=[{
+                            'Destination': {'ToAddresses': [recipient_email_address]},
+                            'ReplacementTemplateData': json.dumps(template_data, ensure_ascii=False),
+                        } for recipient_email_address, template_data in recipients],
+                    )
+                failed_recipients = [recipient for recipient, status in zip(recipients, response['Status']) if status.get('Status') != 'Success']
+                logging.info(f'sent {len(recipients) - len(failed_recipients)} "{template_name}" emails in bulk')
+            except ClientError:
+                logging.exception(f'could not send "{template_name}" emails in bulk')
+
+        for recipient_email_address, template_data in failed_recipients:
+            send_templated_email(template_name, template_data, recipient_email_address)
+
+    def _get_ses_template_name(self, template_name):
+        if template_name not in self.ses_template_names:
+            email_subject, render_email_text = compiled_email_templates[template_name]
+            template_hash = hashlib.sha1(f'{email_subject}\n{render_email_text.template}'.encode('utf-8')).hexdigest()[:10]
+            ses_template_name = f'{SES_TEMPLATE_NAME_PREFIX}-{template_name}-{template_hash}'
+            try:
+                self.rate_limiter.call(self.ses_client.create_template, Template={
+                    'TemplateName': ses_template_name,
+                    'SubjectPart': email_subject,
+                    'TextPart': render_email_text.template,
+                    'HtmlPart': _render_email_html(render_email_text.template),
+                })
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'AlreadyExists':
+                    logging.exception(f'could not create ses template "{ses_template_name}", sending raw emails instead')
+                    ses_template_name = None
+            self.ses_template_names[template_name] = ses_template_name
+        return self.ses_template_names[template_name]
+
+
+def create_apple_wallet_card(vcard_info, signing_context=None):
+    from applepassgenerator.client import ApplePassGeneratorClient
+    from applepassgenerator.models import Generic
+
     card_info = Generic()
 
     membership_year = vcard_info['membership_year']
@@ -148,186 +1075,648 @@ def create_apple_wallet_card(vcard_info):
     apple_pass.foreground_color = 'rgb(255,255,255)'
     apple_pass.label_color = 'rgb(255,255,255)'
 
-    resource_dir_path = os.path.join(SCRIPT_DIR, 'resources')
-    resources = {
-        "logo.png": os.path.join(resource_dir_path, 'assets', 'doc.png'),
-        "logo@2x.png": os.path.join(resource_dir_path, 'assets', 'doc@2x.png'),
-        "logo@3x.png": os.path.join(resource_dir_path, 'assets', 'doc@3x.png'),
-        "icon.png": os.path.join(resource_dir_path, 'assets', 'doc_il.png'),
-        "thumbnail.png": os.path.join(resource_dir_path, 'assets', 'doc_il.png'),
-        "thumbnail@2x.png": os.path.join(resource_dir_path, 'assets', 'doc_il@2x.png'),
-        "thumbnail@3x.png": os.path.join(resource_dir_path, 'assets', 'doc_il@3x.png'),
-        "en.lproj/pass.strings": os.path.join(resource_dir_path, 'en.lproj', 'pass.strings'),
-        "he.lproj/pass.strings": os.path.join(resource_dir_path, 'he.lproj', 'pass.strings'),
-    }
+    if signing_context is None:
+        signing_context = get_apple_pass_signing_context()
+    return signing_context.sign(apple_pass)
+
+
+class MemberRecord:
+    __slots__ = ['email_address', 'phone_number', 'ducati_member_code', 'hebrew_full_name', 'membership_expiration', 'last_renewal_reminder_date', 'revoked',
+                 'vcard_id', 'short_vcard_id', 'bot_status', 'vcard_info', 'content_hash', 'card_unchanged']
+
+    def __init__(self, email_address, phone_number, ducati_member_code, hebrew_full_name, membership_expiration, last_renewal_reminder_date, revoked, vcard_id, bot_status, vcard_info):
+        self.email_address = email_address
+        self.phone_number = phone_number
+        self.ducati_member_code = ducati_member_code
+        self.hebrew_full_name = hebrew_full_name
+        self.membership_expiration = membership_expiration
+        self.last_renewal_reminder_date = last_renewal_reminder_date
+        self.revoked = revoked
+        self.vcard_id = vcard_id
+        self.short_vcard_id = vcard_id[:10]
+        self.bot_status = bot_status
+        self.vcard_info = vcard_info
+        self.content_hash = compute_card_content_hash(vcard_info) if vcard_info else None
+        self.card_unchanged = False
+
+
+class MemberRowParser:
+    # turns sheet rows into MemberRecords. the columns are checked once per sheet and read from each row with a single itemgetter
+    def __init__(self, headers):
+        missing_headers = [header for header in MEMBER_REQUIRED_HEADERS if header not in headers]
+        if missing_headers:
+            raise ValueError(f'the sheet is missing the columns {", ".join(missing_headers)}')
+        self.get_required_fields = operator.itemgetter(*MEMBER_REQUIRED_HEADERS)
+
+    def parse(self, item, now, with_vcard_info=False):
+        email_address, phone_number, membership_year, ducati_member_code, role, hebrew_full_name, english_full_name, tags, motorcycle_model, membership_expiration, registration_type, left = self.get_required_fields(item)
+        if not email_address or not phone_number:
+            return None
+
+        email_address = normalize_email_address(email_address)
+        phone_number = _normalize_phone_number_cached(phone_number)
+        membership_year = membership_year.strip()
+        ducati_member_code = ducati_member_code.strip()
+        role = role.strip()
+        hebrew_full_name = hebrew_full_name.strip()
+        english_full_name = english_full_name.strip()
+        tags = tags.strip().split(',')
+        motorcycle_model = motorcycle_model.strip()
+        membership_expiration = _parse_sheet_date(membership_expiration.strip()) or datetime.datetime(2000, 1, 1)
+        last_renewal_reminder_date = _parse_sheet_date(item.get(HEADER_LAST_RENEWAL_REMINDER_DATE, '').strip()) or datetime.datetime(2000, 1, 1)
+        registration_type = 'זוגי' if registration_type.lower().strip() == 'y' else 'יחיד'
+        revoked = left.lower().strip() in ['y', 'rip'] or now > membership_expiration
+
+        bot_status = item.get(HEADER_BOT_STATUS, '').strip()
+        if bot_status == STATUS_UPDATE_TYPO:
+            bot_status = STATUS_UPDATE
+
+        vcard_info = None
+        if with_vcard_info or bot_status in [STATUS_ISSUE, STATUS_UPDATE]:
+            vcard_info = {
+                "hebrew_full_name": hebrew_full_name,
+                "english_full_name": english_full_name,
+                "membership_year": membership_year,
+                "membership_expiration": membership_expiration.strftime('%Y-%m-%d'),
+                "ducati_member_code": ducati_member_code,
+                "role": role,
+                "tags": tags,
+                "motorcycle_model": motorcycle_model,
+                "registration_type": registration_type,
+            }
 
-    for resource_name, resource_file_path in resources.items():
-        with open(resource_file_path, 'rb') as f:
-            apple_pass.add_file(resource_name, f)
+            if revoked:
+                vcard_info['revoked'] = revoked
 
-    with tempfile.TemporaryDirectory() as temp_dir_path:
-        private_key_file_path = os.path.join(temp_dir_path, 'key.pem')
+        return MemberRecord(email_address, phone_number, ducati_member_code, hebrew_full_name, membership_expiration, last_renewal_reminder_date, revoked,
+                            _derive_vcard_id(email_address, phone_number), bot_status, vcard_info)
 
-        with open(private_key_file_path, 'w+') as f:
-            f.write(APPLE_CARD_PKPASS_PRIVATE_KEY)
 
-        certificate_file_path = os.path.join(resource_dir_path, 'certs', 'certificate.pem')
-        wwdr_certificate_file_path = os.path.join(resource_dir_path, 'certs', 'wwdr.pem')
-        apple_card = apple_pass.create(certificate_file_path,
-                                       private_key_file_path,
-                                       wwdr_certificate_file_path,
-                                       APPLE_CARD_PKPASS_PRIVATE_KEY_PASSWORD)
+@functools.lru_cache(maxsize=MEMBER_PARSE_CACHE_SIZE)
+def _parse_sheet_date(value):
+    # the dates repeat across rows, and are almost always written as yyyy-mm-dd which fromisoformat parses much faster than strptime
+    try:
+        if len(value) == 10 and value[4] == '-' and value[7] == '-':
+            return datetime.datetime.fromisoformat(value)
+        return datetime.datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        return None
 
-        apple_card.seek(0)
-        return apple_card.read()
 
+_normalize_phone_number_cached = functools.lru_cache(maxsize=MEMBER_PARSE_CACHE_SIZE)(normalize_phone_number)
 
-def main():
-    logging.basicConfig(level=logging.INFO)
-    google_sheets_client.reload()
-    total_document_updates_count = 0
-    for index, item in enumerate(google_sheets_client.items):
-        if total_document_updates_count >= MAX_DOCUMENT_UPDATES:
-            logging.info(f'stopping. reached max document updates ({total_document_updates_count})')
-            return
 
-        bot_status = ''
-        try:
-            email_address = item['כתובת אימייל']
-            if not email_address:
-                logging.debug(f'skipping line {index}, empty phone')
-                continue
+@functools.lru_cache(maxsize=MEMBER_PARSE_CACHE_SIZE)
+def _derive_vcard_id(email_address, phone_number):
+    return hashlib.sha1(f'{email_address}:{phone_number}'.encode()).hexdigest()
 
-            email_address = normalize_email_address(email_address)
 
-            phone_number = item['טלפון סלולרי']
-            if not phone_number:
-                logging.debug(f'skipping line {index}, empty phone')
-                continue
+def _submit_apple_wallet_cards(executor, members, outbox):
+    # signing is CPU bound, so the cards of the rows we are going to issue are signed ahead in the worker pool
+    # and collected by the main loop in row order
+    apple_wallet_card_futures = {}
+    for index, item, member in members:
+        if isinstance(member, MemberRecord) and member.vcard_info and not member.card_unchanged and not _is_apple_wallet_card_journaled(member, outbox):
+            apple_wallet_card_futures[index] = executor.submit(create_apple_wallet_card, member.vcard_info)
+    return apple_wallet_card_futures
 
-            phone_number = normalize_phone_number(phone_number)
 
-            membership_year = item['חברות'].strip()
-            ducati_member_code = item['קוד דוקאטי'].strip()
-            role = item['תפקיד'].strip()
-            hebrew_full_name = item['שם מלא בעברית'].strip()
-            english_full_name = item['שם מלא באנגלית'].strip()
-            tags = item['אישור'].strip().split(',')
-            motorcycle_model = item['דגם אופנוע נוכחי'].strip()
-            membership_expiration = item['תפוגה'].strip()
-            try:
-                membership_expiration = datetime.datetime.strptime(membership_expiration, "%Y-%m-%d")
-            except:
-                membership_expiration = datetime.datetime(2000, 1, 1)
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if threading.current_thread() is threading.main_thread():
+        # a cancelled workflow run is terminated with SIGTERM, exit through the finally blocks so pending sheet updates are flushed
+        signal.signal(signal.SIGTERM, _exit_on_signal)
+    _run_sync()
 
-            last_renewal_reminder_date = item[HEADER_LAST_RENEWAL_REMINDER_DATE].strip()
+
+def _run_sync():
+    run_metrics.clear()
+    try:
+        with run_metrics.timed('run'):
+            _sync()
+    finally:
+        # also written for crashed and cancelled runs, which are the ones worth looking at
+        summary = run_metrics.summary()
+        logging.info(f'run metrics: {json.dumps(summary)}')
+        write_run_metrics(summary, RUN_METRICS_PATH, RUN_METRICS_PROMETHEUS_PATH)
+    return summary
+
+
+class SyncDaemon:
+    # runs syncs in one long lived process, so the clients, the signing context and the caches stay warm between them.
+    # the sheet is polled again soon while there is work and less and less often while there is none,
+    # and right away when a sync is requested, e.g. by the trigger endpoint on a form submission
+
+    def __init__(self, sync, min_poll_interval_seconds, max_poll_interval_seconds):
+        self.sync = sync
+        self.min_poll_interval_seconds = min_poll_interval_seconds
+        self.max_poll_interval_seconds = max_poll_interval_seconds
+        self.poll_interval_seconds = min_poll_interval_seconds
+        self.sync_requested = threading.Event()
+        self.stopping = threading.Event()
+        self.syncs_count = 0
+        self.last_sync_at = None
+        self.last_sync_failed = False
+
+    def request_sync(self):
+        self.sync_requested.set()
+
+    def stop(self):
+        self.stopping.set()
+        self.sync_requested.set()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.sync_requested.clear()
             try:
-                last_renewal_reminder_date = datetime.datetime.strptime(last_renewal_reminder_date, "%Y-%m-%d")
-            except:
-                last_renewal_reminder_date = datetime.datetime(2000, 1, 1)
-
-            now = datetime.datetime.now()
-            registration_type = 'זוגי' if item['זוגי'].lower().strip() == 'y' else 'יחיד'
-            revoked = item['עזב'].lower().strip() in ['y', 'rip'] or now > membership_expiration
-            vcard_id = f'{email_address}:{phone_number}'
-            vcard_id = vcard_id.encode()
-            vcard_id = hashlib.sha1(vcard_id).hexdigest()
-            short_vcard_id = vcard_id[:10]
-
-            bot_status = item.get(HEADER_BOT_STATUS, '').strip()
-            if bot_status == STATUS_UPDATE_TYPO:
-                bot_status = STATUS_UPDATE
-
-            if bot_status in [STATUS_ISSUE, STATUS_UPDATE]:
-                vcard_info = {
-                    "hebrew_full_name": hebrew_full_name,
-                    "english_full_name": english_full_name,
-                    "membership_year": membership_year,
-                    "membership_expiration": membership_expiration.strftime('%Y-%m-%d'),
-                    "ducati_member_code": ducati_member_code,
-                    "role": role,
-                    "tags": tags,
-                    "motorcycle_model": motorcycle_model,
-                    "registration_type": registration_type,
-                }
+                summary = self.sync()
+            except Exception:
+                logging.exception('sync failed')
+                self.last_sync_failed = True
+                self.poll_interval_seconds = min(self.poll_interval_seconds * 2, self.max_poll_interval_seconds)
+            else:
+                self.last_sync_failed = False
+                self.poll_interval_seconds = self.get_next_poll_interval_seconds(summary)
+            self.syncs_count += 1
+            self.last_sync_at = datetime.datetime.now()
+            if not self.stopping.is_set():
+                logging.info(f'next sync in {self.poll_interval_seconds:.0f} seconds or when requested')
+                self.sync_requested.wait(self.poll_interval_seconds)
+
+    def get_next_poll_interval_seconds(self, summary):
+        # polls again soon after a sync that had work, or left some for the next sync.
+        # rows without work, e.g. missing a phone number, are parsed again on every sync and don't count
+        if any(name.startswith(('planned_', 'deferred_')) for name in summary['counters']):
+            return self.min_poll_interval_seconds
+        return min(self.poll_interval_seconds * 2, self.max_poll_interval_seconds)
+
+
+class SyncTriggerRequestHandler(http.server.BaseHTTPRequestHandler):
+    # POST /sync requests a sync, GET /health reports the last one
+
+    def do_POST(self):
+        if self.path != '/sync':
+            self.send_json(404, {'error': 'not found'})
+            return
+        trigger_token = self.server.trigger_token
+        if trigger_token and not hmac.compare_digest(self.headers.get('X-Trigger-Token', '').encode(), trigger_token.encode()):
+            self.send_json(403, {'error': 'invalid trigger token'})
+            return
+        self.server.sync_daemon.request_sync()
+        self.send_json(202, {'sync_requested': True})
 
-                if revoked:
-                    vcard_info['revoked'] = revoked
-                    logging.info(f'revoked card #{index}')
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, {'error': 'not found'})
+            return
+        sync_daemon = self.server.sync_daemon
+        self.send_json(500 if sync_daemon.last_sync_failed else 200, {
+            'syncs': sync_daemon.syncs_count,
+            'last_sync_at': sync_daemon.last_sync_at.isoformat(timespec='seconds') if sync_daemon.last_sync_at else None,
+            'last_sync_failed': sync_daemon.last_sync_failed,
+            'poll_interval_seconds': sync_daemon.poll_interval_seconds,
+        })
+
+    def send_json(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f'trigger endpoint: {format % args}')
+
+
+def create_sync_trigger_server(sync_daemon, host, port, trigger_token=None):
+    trigger_server = http.server.ThreadingHTTPServer((host, port), SyncTriggerRequestHandler)
+    trigger_server.daemon_threads = True
+    trigger_server.sync_daemon = sync_daemon
+    trigger_server.trigger_token = trigger_token
+    return trigger_server
+
+
+def run_daemon(host, port, trigger_token=None):
+    global _apple_card_signing_executor
+    logging.basicConfig(level=logging.INFO)
+    sync_daemon = SyncDaemon(_run_daemon_sync, DAEMON_MIN_POLL_INTERVAL_SECONDS, DAEMON_MAX_POLL_INTERVAL_SECONDS)
+    if APPLE_CARD_SIGNING_WORKERS > 1:
+        # created before the trigger endpoint thread is started, so the workers aren't forked from a threaded process
+        _apple_card_signing_executor = create_apple_card_signing_executor()
+
+    def stop_on_signal(signum, frame):
+        # the current sync is finished first, a second signal exits right away through the finally blocks
+        logging.info(f'stopping after the current sync, received signal {signum}')
+        signal.signal(signal.SIGTERM, _exit_on_signal)
+        signal.signal(signal.SIGINT, _exit_on_signal)
+        sync_daemon.stop()
+
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    signal.signal(signal.SIGINT, stop_on_signal)
+    trigger_server = create_sync_trigger_server(sync_daemon, host, port, trigger_token)
+    threading.Thread(target=trigger_server.serve_forever, name='sync-trigger', daemon=True).start()
+    logging.info(f'listening for sync triggers on http://{host}:{trigger_server.server_port}/sync')
+    try:
+        sync_daemon.run()
+    finally:
+        trigger_server.shutdown()
+        trigger_server.server_close()
+        if _apple_card_signing_executor:
+            _apple_card_signing_executor.shutdown(cancel_futures=True)
+            _apple_card_signing_executor = None
+
+
+def _run_daemon_sync():
+    global _apple_card_signing_executor
+    if _apple_card_signing_executor:
+        try:
+            _apple_card_signing_executor.submit(int).result()
+        except concurrent.futures.BrokenExecutor:
+            # a worker died, e.g. killed for memory. the new pool is forked next to the trigger endpoint thread, which only
+            # serves requests and holds no locks the workers use
+            logging.warning('the card signing pool is broken, recreating it')
+            _apple_card_signing_executor.shutdown(cancel_futures=True)
+            _apple_card_signing_executor = create_apple_card_signing_executor()
+    return _run_sync()
+
+
+def _sync():
+    rate_limiters['sheets'].call(services.google_sheets_client.reload)
+    now = datetime.datetime.now()
+    with contextlib.closing(open_state_db(STATE_DB_PATH)) as state_db:
+        row_snapshot_store = RowSnapshotStore(state_db)
+        renewal_index = RenewalIndex(state_db)
+        full_rescan = not INCREMENTAL_SYNC or FORCE_FULL_RESCAN or row_snapshot_store.is_full_rescan_due(now, FULL_RESCAN_INTERVAL_HOURS)
+        row_parser = MemberRowParser(services.google_sheets_client.headers)
+        members = sorted(_iter_changed_members(services.google_sheets_client.items, row_parser, row_snapshot_store, renewal_index, full_rescan, now), key=lambda member: member[0])
+        row_snapshot_store.commit()
+        if full_rescan:
+            row_snapshot_store.set_last_full_rescan(now)
+        logging.info(f'{len(members)} new or changed rows out of {len(services.google_sheets_client.items)} (full rescan: {full_rescan})')
+        run_metrics.increment('rows', len(services.google_sheets_client.items))
+        run_metrics.increment('changed_rows', len(members))
+
+        card_state_store = CardStateStore(state_db, services.aws_s3_resource.meta.client, services.aws_s3_bucket_name)
+        outbox = OutboxJournal(state_db)
+        short_link_index = ShortLinkIndex(state_db, services.aws_s3_resource.meta.client, services.aws_s3_bucket_name)
+        if full_rescan:
+            # also indexes the links of the cards published before the index existed, including revoked cards and rows whose
+            # status changed since. published means known to the state database or having a short/ object on s3
+            published_vcard_ids = card_state_store.get_vcard_ids()
+            short_link_object_ids = short_link_index.list_short_link_objects()
+            for _, _, member in members:
+                if isinstance(member, MemberRecord) and (member.vcard_id in published_vcard_ids or member.short_vcard_id in short_link_object_ids):
+                    short_link_index.add(member.short_vcard_id, member.vcard_id)
+
+        members = _plan_work(members, now, MAX_DOCUMENT_UPDATES, WORK_PRIORITY_WEIGHTS, WORK_CLASS_QUOTAS)
+        if not FORCE_CARD_REPUBLISH:
+            _mark_unchanged_cards(members, card_state_store)
+
+        executor = None
+        apple_wallet_card_futures = {}
+        if APPLE_CARD_SIGNING_WORKERS > 1:
+            executor = _apple_card_signing_executor or create_apple_card_signing_executor()
+            apple_wallet_card_futures = _submit_apple_wallet_cards(executor, members, outbox)
 
-                vcard_info_json = json.dumps(vcard_info)
-                vcard_info_json_encoded = vcard_info_json.encode('utf-8')
-                aws_s3_resource.meta.client.put_object(Body=vcard_info_json_encoded, Bucket=AWS_S3_BUCKET_NAME, Key=f'card/{vcard_id}.json', ACL='public-read')
+        try:
+            with SheetWriteBuffer(services.google_sheets_client) as sheet_write_buffer, contextlib.ExitStack() as exit_stack, S3Publisher(services.aws_s3_publisher_client, services.aws_s3_bucket_name) as s3_publisher:
+                email_sender = None
+                if SES_BULK_SENDING:
+                    email_sender = exit_stack.enter_context(BulkEmailSender(services.aws_ses_client))
+                # on exit, before the last queued emails are sent
+                exit_stack.callback(short_link_index.flush)
+
+                def before_sheet_flush():
+                    # the short links of the queued emails are indexed, and the emails are sent, before the sheet marks their rows as done
+                    short_link_index.flush()
+                    if email_sender:
+                        email_sender.flush()
+
+                sheet_write_buffer.before_flush = before_sheet_flush
+                sheet_write_buffer.after_flush = outbox.flush_completed
+                _process_members(members, apple_wallet_card_futures, s3_publisher, sheet_write_buffer, card_state_store, email_sender, outbox, short_link_index, now)
+        finally:
+            # the cards of the rows left unprocessed, e.g. by a crash, aren't signed in the shared pool of the daemon
+            for apple_wallet_card_future in apple_wallet_card_futures.values():
+                apple_wallet_card_future.cancel()
+            if executor and executor is not _apple_card_signing_executor:
+                executor.shutdown(cancel_futures=True)
+
+
+def _iter_changed_members(items, row_parser, row_snapshot_store, renewal_index, full_rescan, now):
+    # rows without pending work are remembered by their fingerprint and skipped while they stay the same.
+    # the skipped rows that became due for a renewal reminder are found through the renewal index
+    skipped_item_indexes = {}
+    parsed_vcard_ids = set()
+    for index, item in enumerate(items):
+        fingerprint = compute_item_fingerprint(item)
+        if not full_rescan and row_snapshot_store.is_unchanged(fingerprint):
+            skipped_item_indexes[fingerprint] = index
+            continue
+
+        member = _parse_changed_item(row_parser, item, fingerprint, row_snapshot_store, renewal_index, now)
+        if isinstance(member, MemberRecord):
+            parsed_vcard_ids.add(member.vcard_id)
+        yield index, item, member
+
+    if full_rescan:
+        renewal_index.retain(parsed_vcard_ids)
+        return
+
+    for vcard_id, fingerprint in renewal_index.get_due(now):
+        if vcard_id in parsed_vcard_ids:
+            continue
+
+        index = skipped_item_indexes.get(fingerprint)
+        if index is None:
+            # the row was removed from the sheet
+            renewal_index.remove(vcard_id)
+            continue
+
+        item = items[index]
+        yield index, item, _parse_changed_item(row_parser, item, fingerprint, row_snapshot_store, renewal_index, now)
+
+
+def _parse_changed_item(row_parser, item, fingerprint, row_snapshot_store, renewal_index, now):
+    try:
+        with run_metrics.timed('parse_item'):
+            member = row_parser.parse(item, now)
+    except Exception as e:
+        return e
+
+    if isinstance(member, MemberRecord):
+        renewal_index.update(member, fingerprint)
+        if not member.vcard_info and not _is_renewal_notification_due(member, now):
+            row_snapshot_store.add(member.vcard_id, fingerprint)
+    return member
+
+
+def _mark_unchanged_cards(members, card_state_store):
+    for index, item, member in members:
+        if isinstance(member, MemberRecord) and member.vcard_info:
+            member.card_unchanged = card_state_store.get_content_hash(member.vcard_id, get_card_object_keys(member.vcard_id, member.short_vcard_id)) == member.content_hash
+
+
+def _plan_work(members, now, max_document_updates, weights, quotas):
+    # spends the budget of document updates of a run by priority instead of by row order, so new members get their card
+    # in the next run wherever their row is. a class can't take more than its quota of the budget, unless the budget
+    # would otherwise be left unused. the planned rows are processed in row order
+    work_items = []
+    for position, (index, item, member) in enumerate(members):
+        work_class, document_updates_count = _classify_work(member, now)
+        if work_class:
+            work_items.append((-weights[work_class], index, position, work_class, document_updates_count))
+    work_items.sort()
+
+    remaining_document_updates = max_document_updates
+    class_document_updates = collections.Counter()
+    planned_positions = []
+    held_back_work_items = []
+    for work_item in work_items:
+        _, _, position, work_class, document_updates_count = work_item
+        if document_updates_count > remaining_document_updates:
+            continue
+        if class_document_updates[work_class] + document_updates_count > quotas[work_class] * max_document_updates:
+            held_back_work_items.append(work_item)
+            continue
+        planned_positions.append(position)
+        class_document_updates[work_class] += document_updates_count
+        remaining_document_updates -= document_updates_count
+
+    for _, _, position, work_class, document_updates_count in held_back_work_items:
+        if document_updates_count <= remaining_document_updates:
+            planned_positions.append(position)
+            class_document_updates[work_class] += document_updates_count
+            remaining_document_updates -= document_updates_count
+
+    work_counts = collections.Counter(work_class for _, _, _, work_class, _ in work_items)
+    planned_positions_set = set(planned_positions)
+    planned_counts = collections.Counter(work_class for _, _, position, work_class, _ in work_items if position in planned_positions_set)
+    for work_class, work_count in sorted(work_counts.items()):
+        run_metrics.increment(f'planned_{work_class}', planned_counts[work_class])
+        if work_count > planned_counts[work_class]:
+            run_metrics.increment(f'deferred_{work_class}', work_count - planned_counts[work_class])
+            logging.info(f'deferring {work_count - planned_counts[work_class]} of {work_count} "{work_class}" rows to the next run, reached max document updates')
+    return [members[position] for position in sorted(planned_positions)]
+
+
+def _classify_work(member, now):
+    if member is None:
+        return None, 0
+    if isinstance(member, Exception):
+        return WORK_CLASS_ERROR, 1
+
+    renewal_notification_due = _is_renewal_notification_due(member, now)
+    document_updates_count = (1 if member.vcard_info else 0) + (1 if renewal_notification_due else 0)
+    if member.vcard_info:
+        if member.revoked:
+            return WORK_CLASS_REVOKE, document_updates_count
+        return (WORK_CLASS_UPDATE if member.bot_status == STATUS_UPDATE else WORK_CLASS_ISSUE), document_updates_count
+    if renewal_notification_due:
+        return WORK_CLASS_RENEWAL, document_updates_count
+    return None, 0
+
+
+def _is_renewal_notification_due(member, now):
+    if member.revoked:
+        return False
+
+    days_till_expiration = (member.membership_expiration - now).days
+    if not 0 <= days_till_expiration <= RENEWAL_NOTIFICATIONS_PERIOD_DAYS:
+        return False
+
+    days_since_last_renewal_reminder_date = (now - member.last_renewal_reminder_date).days
+    return days_since_last_renewal_reminder_date >= RENEWAL_NOTIFICATIONS_TTL_DAYS
+
+
+def _process_members(members, apple_wallet_card_futures, s3_publisher, sheet_write_buffer, card_state_store, email_sender, outbox, short_link_index, now):
+    # the uploads of a row are started as soon as it is reached, but its notifications and sheet updates
+    # are only completed, in row order, once up to AWS_S3_MAX_PENDING_CARDS later rows have started theirs
+    pending_members = collections.deque()
+    for index, item, member in members:
+        if member is None:
+            logging.debug(f'skipping line {index}, empty email or phone')
+            continue
+
+        if isinstance(member, Exception):
+            logging.error(f'failed issuing card for line #{index}', exc_info=member)
+            _set_error_status(sheet_write_buffer, item, member, outbox)
+            continue
+
+        if not member.vcard_info and not _is_renewal_notification_due(member, now):
+            continue
 
+        try:
+            uploads = _publish_member(index, member, apple_wallet_card_futures, s3_publisher, outbox, short_link_index)
+        except Exception:
+            logging.exception(f'failed issuing card for line #{index}')
+            _set_error_status(sheet_write_buffer, item, member, outbox)
+            continue
+
+        pending_members.append((index, item, member, uploads))
+        while len(pending_members) > AWS_S3_MAX_PENDING_CARDS:
+            index, item, member, uploads = pending_members.popleft()
+            _complete_member(sheet_write_buffer, card_state_store, email_sender, outbox, index, item, member, uploads, now)
+
+    while pending_members:
+        index, item, member, uploads = pending_members.popleft()
+        _complete_member(sheet_write_buffer, card_state_store, email_sender, outbox, index, item, member, uploads, now)
+
+
+def _publish_member(index, member, apple_wallet_card_futures, s3_publisher, outbox, short_link_index):
+    vcard_info = member.vcard_info
+    if not vcard_info:
+        return []
+
+    vcard_id = member.vcard_id
+    if member.card_unchanged:
+        logging.info(f'card for line #{index} is unchanged, skipping publishing')
+        run_metrics.increment('unchanged_cards')
+        return []
+
+    if member.revoked:
+        logging.info(f'revoked card #{index}')
+
+    content_hash = member.content_hash
+    short_link_index.add(member.short_vcard_id, vcard_id)
+    uploads = []
+    for key, body, metadata in _get_card_json_objects(member):
+        if not outbox.has_step(vcard_id, f'{OUTBOX_STEP_UPLOADED}:{key}', content_hash):
+            uploads.append((key, s3_publisher.put_object(key, body, metadata=metadata)))
+
+    apple_wallet_card_key = f'apple_card/{vcard_id}.pkpass'
+    if outbox.has_step(vcard_id, f'{OUTBOX_STEP_UPLOADED}:{apple_wallet_card_key}', content_hash):
+        return uploads
+
+    apple_wallet_card = outbox.get_payload(vcard_id, OUTBOX_STEP_SIGNED, content_hash)
+    if apple_wallet_card is None:
+        # with signing workers this is the time spent waiting for the card, not the time it took to sign it
+        with run_metrics.timed('create_apple_wallet_card'):
+            apple_wallet_card_future = apple_wallet_card_futures.get(index)
+            if apple_wallet_card_future:
+                apple_wallet_card = apple_wallet_card_future.result()
+            else:
                 apple_wallet_card = create_apple_wallet_card(vcard_info)
-                aws_s3_resource.meta.client.put_object(Body=apple_wallet_card, Bucket=AWS_S3_BUCKET_NAME, Key=f'apple_card/{vcard_id}.pkpass', ACL='public-read')
+        outbox.record(vcard_id, [OUTBOX_STEP_SIGNED], content_hash, apple_wallet_card)
+    uploads.append((apple_wallet_card_key, s3_publisher.put_object(apple_wallet_card_key, apple_wallet_card, metadata={CARD_CONTENT_HASH_METADATA_KEY: content_hash})))
+    return uploads
 
-                short_url_info = json.dumps({
-                    'id': vcard_id
-                })
-                short_url_info = short_url_info.encode('utf-8')
-                aws_s3_resource.meta.client.put_object(Body=short_url_info, Bucket=AWS_S3_BUCKET_NAME, Key=f'short/{short_vcard_id}.json', ACL='public-read')
-
-                if not revoked and bot_status != STATUS_UPDATE:
-                    _send_issue_notification(ducati_member_code, email_address, hebrew_full_name, phone_number, short_vcard_id, membership_expiration)
-
-                new_status = f'{bot_status} - {STATUS_DONE}'
-                logging.info(f'issued card for line #{index}')
-                google_sheets_client.set_item_field(item, HEADER_BOT_STATUS, new_status)
-                time.sleep(RATE_LIMIT_SLEEP_INTERVAL_SECONDS)
-                total_document_updates_count += 1
-
-            if not revoked:
-                days_till_expiration = (membership_expiration - now).days
-                if 0 <= days_till_expiration <= RENEWAL_NOTIFICATIONS_PERIOD_DAYS:
-                    days_since_last_renewal_reminder_date = (now - last_renewal_reminder_date).days
-                    if days_since_last_renewal_reminder_date >= RENEWAL_NOTIFICATIONS_TTL_DAYS:
-                        logging.info(f'renewal notice sent for line #{index}')
-                        _send_renewal_notification(ducati_member_code, email_address, hebrew_full_name, phone_number, membership_expiration, days_till_expiration)
-                        value = now.strftime("%Y-%m-%d")
-                        google_sheets_client.set_item_field(item, HEADER_LAST_RENEWAL_REMINDER_DATE, value)
-                        time.sleep(RATE_LIMIT_SLEEP_INTERVAL_SECONDS)
-                        total_document_updates_count += 1
 
-        except:
-            logging.exception(f'failed issuing card for line #{index}')
-            new_status = f'{bot_status} - {STATUS_ERROR}' if bot_status else STATUS_ERROR
-            google_sheets_client.set_item_field(item, HEADER_BOT_STATUS, new_status)
-            time.sleep(RATE_LIMIT_SLEEP_INTERVAL_SECONDS)
-            total_document_updates_count += 1
+def _get_card_json_objects(member):
+    vcard_info_json = json.dumps(member.vcard_info)
+    vcard_info_json_encoded = vcard_info_json.encode('utf-8')
+    short_url_info = json.dumps({
+        'id': member.vcard_id
+    })
+    short_url_info = short_url_info.encode('utf-8')
+    card_json_objects = [(f'card/{member.vcard_id}.json', vcard_info_json_encoded, {CARD_CONTENT_HASH_METADATA_KEY: member.content_hash})]
+    if SHORT_LINK_OBJECTS:
+        card_json_objects.append((f'short/{member.short_vcard_id}.json', short_url_info, {CARD_CONTENT_HASH_METADATA_KEY: member.content_hash}))
+    return card_json_objects
 
 
-def _send_issue_notification(ducati_member_code, email_address, hebrew_full_name, phone_number, short_vcard_id, membership_expiration):
-    is_invalid_ducati_member_code = not re.match(r'^\d+$', ducati_member_code)
-    membership_expiration = membership_expiration.strftime("%d/%m/%Y")
-    short_card_url = f'https://card.docil.co.il/#/{short_vcard_id}'
-    sms_message = SMS_TEMPLATE_ISSUE_SUCCESS.replace('{{hebrew_full_name}}', hebrew_full_name).replace('{{card_url}}', short_card_url)
-    if is_invalid_ducati_member_code:
-        sms_message = f'{sms_message}\n{TEMPLATE_ISSUE_MISSING_DUCATI_MEMBER_CODE}'
-    send_sms(phone_number, sms_message)
-    email_message = EMAIL_TEMPLATE_ISSUE_SUCCESS.replace('{{hebrew_full_name}}', hebrew_full_name).replace('{{membership_expiration}}', membership_expiration).replace('{{ducati_member_code}}', ducati_member_code).replace('{{card_url}}', short_card_url)
-    if is_invalid_ducati_member_code:
-        email_message = f'{email_message}\n{TEMPLATE_ISSUE_MISSING_DUCATI_MEMBER_CODE}'
-    send_email(EMAIL_SUBJECT_ISSUE, email_message, email_address)
+def _is_apple_wallet_card_journaled(member, outbox):
+    vcard_id = member.vcard_id
+    return outbox.has_step(vcard_id, OUTBOX_STEP_SIGNED, member.content_hash) or outbox.has_step(vcard_id, f'{OUTBOX_STEP_UPLOADED}:apple_card/{vcard_id}.pkpass', member.content_hash)
 
 
-def _send_renewal_notification(ducati_member_code, email_address, hebrew_full_name, phone_number, membership_expiration, days_till_expiration):
+def _complete_member(sheet_write_buffer, card_state_store, email_sender, outbox, index, item, member, uploads, now):
+    document_updates_count = 0
+    sheet_updates = {}
+    try:
+        bot_status = member.bot_status
+        email_address = member.email_address
+        phone_number = member.phone_number
+        ducati_member_code = member.ducati_member_code
+        hebrew_full_name = member.hebrew_full_name
+        membership_expiration = member.membership_expiration
+        revoked = member.revoked
+        vcard_id = member.vcard_id
+
+        if member.vcard_info:
+            for key, upload in uploads:
+                upload.result()
+                outbox.record(vcard_id, [f'{OUTBOX_STEP_UPLOADED}:{key}'], member.content_hash)
+
+            if not member.card_unchanged:
+                card_state_store.set_content_hash(vcard_id, member.content_hash)
+                run_metrics.increment('published_cards')
+
+            if not revoked and bot_status != STATUS_UPDATE:
+                if outbox.has_step(vcard_id, OUTBOX_STEP_ISSUE_NOTIFIED):
+                    logging.info(f'issue notification for line #{index} was already sent by an interrupted run')
+                else:
+                    outbox.record(vcard_id, [OUTBOX_STEP_ISSUE_NOTIFIED])
+                    _send_issue_notification(ducati_member_code, email_address, hebrew_full_name, phone_number, member.short_vcard_id, membership_expiration, email_sender)
+                    run_metrics.increment('issue_notifications')
+
+            logging.info(f'issued card for line #{index}')
+            sheet_updates[HEADER_BOT_STATUS] = f'{bot_status} - {STATUS_DONE}'
+
+        if _is_renewal_notification_due(member, now):
+            days_till_expiration = (membership_expiration - now).days
+            if outbox.has_step(vcard_id, OUTBOX_STEP_RENEWAL_NOTIFIED):
+                logging.info(f'renewal notice for line #{index} was already sent by an interrupted run')
+            else:
+                outbox.record(vcard_id, [OUTBOX_STEP_RENEWAL_NOTIFIED])
+                logging.info(f'renewal notice sent for line #{index}')
+                _send_renewal_notification(ducati_member_code, email_address, hebrew_full_name, phone_number, membership_expiration, days_till_expiration, email_sender)
+                run_metrics.increment('renewal_notifications')
+            sheet_updates[HEADER_LAST_RENEWAL_REMINDER_DATE] = now.strftime("%Y-%m-%d")
+
+        if sheet_updates:
+            # completed before its sheet updates are buffered, so the flush that writes them also clears its outbox steps
+            outbox.complete(vcard_id)
+            sheet_write_buffer.set_item_fields(item, sheet_updates)
+            document_updates_count += len(sheet_updates)
+
+    except Exception:
+        # SystemExit from a cancelled run is not a row error, the row is resumed from the outbox by the next run
+        logging.exception(f'failed issuing card for line #{index}')
+        document_updates_count += _set_error_status(sheet_write_buffer, item, member, outbox)
+
+    return document_updates_count
+
+
+def _set_error_status(sheet_write_buffer, item, member, outbox):
+    bot_status = member.bot_status if isinstance(member, MemberRecord) else ''
+    new_status = f'{bot_status} - {STATUS_ERROR}' if bot_status else STATUS_ERROR
+    run_metrics.increment('errors')
+    sheet_write_buffer.set_item_field(item, HEADER_BOT_STATUS, new_status)
+    if isinstance(member, MemberRecord):
+        # a failed row is started over once its status is set again
+        outbox.complete(member.vcard_id)
+    return 1
+
+
+def _send_issue_notification(ducati_member_code, email_address, hebrew_full_name, phone_number, short_vcard_id, membership_expiration, email_sender=None):
     is_invalid_ducati_member_code = not re.match(r'^\d+$', ducati_member_code)
-
-    membership_expiration = f'{membership_expiration.strftime("%d/%m/%Y")} (בעוד {days_till_expiration} ימים)'
+    template_data = {
+        'hebrew_full_name': hebrew_full_name,
+        'membership_expiration': membership_expiration.strftime("%d/%m/%Y"),
+        'ducati_member_code': ducati_member_code,
+        'card_url': f'https://card.docil.co.il/#/{short_vcard_id}',
+    }
+    sms_message = compiled_sms_templates['issue'](template_data)
     if is_invalid_ducati_member_code:
-        sms_message = SMS_TEMPLATE_RENEWAL_REQUEST_INVALID_CODE.replace('{{hebrew_full_name}}', hebrew_full_name).replace('{{hebrew_full_name}}', hebrew_full_name).replace('{{membership_expiration}}', membership_expiration).replace('{{contact_phone_number}}', CONTACT_PHONE_NUMBER)
-    else:
-        sms_message = SMS_TEMPLATE_RENEWAL_REQUEST.replace('{{hebrew_full_name}}', hebrew_full_name).replace('{{ducati_member_code}}', ducati_member_code).replace('{{membership_expiration}}', membership_expiration).replace('{{contact_phone_number}}', CONTACT_PHONE_NUMBER)
-
+        sms_message = f'{sms_message}\n{TEMPLATE_ISSUE_MISSING_DUCATI_MEMBER_CODE}'
     send_sms(phone_number, sms_message)
+    template_name = 'issue_missing_ducati_member_code' if is_invalid_ducati_member_code else 'issue'
+    send_templated_email(template_name, template_data, email_address, email_sender)
 
-    if is_invalid_ducati_member_code:
-        email_message = EMAIL_TEMPLATE_RENEWAL_REQUEST_INVALID_CODE.replace('{{hebrew_full_name}}', hebrew_full_name).replace('{{membership_expiration}}', membership_expiration).replace('{{contact_phone_number}}', CONTACT_PHONE_NUMBER)
-    else:
-        email_message = EMAIL_TEMPLATE_RENEWAL_REQUEST.replace('{{hebrew_full_name}}', hebrew_full_name).replace('{{ducati_member_code}}', ducati_member_code).replace('{{membership_expiration}}', membership_expiration).replace('{{contact_phone_number}}', CONTACT_PHONE_NUMBER)
 
-    send_email(EMAIL_SUBJECT_RENEWAL_REQUEST, email_message, email_address)
+def _send_renewal_notification(ducati_member_code, email_address, hebrew_full_name, phone_number, membership_expiration, days_till_expiration, email_sender=None):
+    is_invalid_ducati_member_code = not re.match(r'^\d+$', ducati_member_code)
+    template_data = {
+        'hebrew_full_name': hebrew_full_name,
+        'membership_expiration': f'{membership_expiration.strftime("%d/%m/%Y")} (בעוד {days_till_expiration} ימים)',
+        'ducati_member_code': ducati_member_code,
+        'contact_phone_number': services.contact_phone_number,
+    }
+    template_name = 'renewal_request_invalid_code' if is_invalid_ducati_member_code else 'renewal_request'
+    send_sms(phone_number, compiled_sms_templates[template_name](template_data))
+    send_templated_email(template_name, template_data, email_address, email_sender)
 
 
 EMAIL_TEMPLATE_ISSUE_SUCCESS = '''
@@ -442,5 +1831,177 @@ https://wa.me/{{contact_phone_number}}
 
 '''
 
+
+def print_renewal_forecast(days):
+    # reads the renewal index of the state database, in production the state directory of the cron workflow's cache.
+    # without one, e.g. on another machine, the index is built from the sheet
+    logging.basicConfig(level=logging.INFO)
+    now = datetime.datetime.now()
+    with contextlib.closing(open_state_db(STATE_DB_PATH)) as state_db:
+        renewal_index = RenewalIndex(state_db)
+        if renewal_index.is_empty():
+            reminders = _get_upcoming_renewal_reminders_from_sheet(now, days)
+        else:
+            reminders = renewal_index.get_upcoming(now, days)
+
+    reminders_per_day = collections.Counter(reminder_date.date() for reminder_date, _ in reminders)
+    for reminder_date, reminders_count in sorted(reminders_per_day.items()):
+        print(f'{reminder_date.isoformat()}\t{reminders_count}')
+    print(f'total\t{len(reminders)}')
+
+
+def _get_upcoming_renewal_reminders_from_sheet(now, days):
+    logging.info(f'the renewal index of {STATE_DB_PATH} is empty, building it from the sheet')
+    rate_limiters['sheets'].call(services.google_sheets_client.reload)
+    row_parser = MemberRowParser(services.google_sheets_client.headers)
+    with contextlib.closing(open_state_db(':memory:')) as state_db:
+        renewal_index = RenewalIndex(state_db)
+        for index, item in enumerate(services.google_sheets_client.items):
+            try:
+                member = row_parser.parse(item, now)
+            except Exception:
+                logging.warning(f'skipping line #{index}, could not parse it')
+                continue
+            if member:
+                renewal_index.update(member, compute_item_fingerprint(item))
+        return renewal_index.get_upcoming(now, days)
+
+
+class CardArchiveWriter:
+    # writes the exported cards one entry at a time to a zip, or to a streamed tar when the path ends with .tar, .tar.gz or .tgz,
+    # so only the entry being written is held in memory
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        if archive_path.endswith(('.tar.gz', '.tgz')):
+            self.tar_file = tarfile.open(archive_path, 'w|gz')
+            self.zip_file = None
+        elif archive_path.endswith('.tar'):
+            self.tar_file = tarfile.open(archive_path, 'w|')
+            self.zip_file = None
+        else:
+            self.tar_file = None
+            self.zip_file = zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, name, data):
+        if self.zip_file:
+            # pkpass files are zip files already
+            self.zip_file.writestr(name, data, compress_type=zipfile.ZIP_STORED if name.endswith('.pkpass') else zipfile.ZIP_DEFLATED)
+        else:
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = len(data)
+            tar_info.mtime = int(time.time())
+            self.tar_file.addfile(tar_info, io.BytesIO(data))
+            # tarfile remembers every member it wrote, which isn't needed when only writing
+            self.tar_file.members.clear()
+
+    def close(self):
+        (self.zip_file or self.tar_file).close()
+
+
+def export_cards(archive_path, upload_key=None):
+    # signs the cards of all members, whatever their status, into one archive laid out like the bucket,
+    # e.g. to re-issue every card after a certificate or logo change without going through MAX_DOCUMENT_UPDATES per run
+    logging.basicConfig(level=logging.INFO)
+    rate_limiters['sheets'].call(services.google_sheets_client.reload)
+    now = datetime.datetime.now()
+    row_parser = MemberRowParser(services.google_sheets_client.headers)
+    members = _iter_exported_members(services.google_sheets_client.items, row_parser, now)
+
+    executor = None
+    if APPLE_CARD_SIGNING_WORKERS > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=APPLE_CARD_SIGNING_WORKERS, initializer=get_apple_pass_signing_context)
+    cards_count = 0
+    short_link_shards = collections.defaultdict(dict)
+    try:
+        with CardArchiveWriter(archive_path) as card_archive_writer:
+            for member, apple_wallet_card in _iter_signed_cards(members, executor):
+                for key, body, _ in _get_card_json_objects(member):
+                    card_archive_writer.add(key, body)
+                card_archive_writer.add(f'apple_card/{member.vcard_id}.pkpass', apple_wallet_card)
+                short_link_shards[member.short_vcard_id[:SHORT_LINK_INDEX_PREFIX_LENGTH]][member.short_vcard_id] = member.vcard_id
+                cards_count += 1
+                if cards_count % 1000 == 0:
+                    logging.info(f'exported {cards_count} cards')
+            # the short link index, as ShortLinkIndex uploads it
+            for shard, short_links in sorted(short_link_shards.items()):
+                card_archive_writer.add(f'{SHORT_LINK_INDEX_KEY_PREFIX}/{shard}.json', json.dumps(dict(sorted(short_links.items()))).encode('utf-8'))
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    logging.info(f'exported {cards_count} cards and {len(short_link_shards)} short link index shards to {archive_path}')
+
+    if upload_key:
+        from boto3.s3.transfer import TransferConfig
+        # upload_file sends large files as a multipart upload, reading one chunk at a time
+        transfer_config = TransferConfig(multipart_threshold=EXPORT_MULTIPART_CHUNK_SIZE, multipart_chunksize=EXPORT_MULTIPART_CHUNK_SIZE, max_concurrency=AWS_S3_MAX_CONCURRENT_UPLOADS)
+        services.aws_s3_resource.meta.client.upload_file(archive_path, services.aws_s3_bucket_name, upload_key, Config=transfer_config)
+        logging.info(f'uploaded {archive_path} to s3://{services.aws_s3_bucket_name}/{upload_key}')
+
+
+def _iter_exported_members(items, row_parser, now):
+    for index, item in enumerate(items):
+        try:
+            member = row_parser.parse(item, now, with_vcard_info=True)
+        except Exception:
+            logging.exception(f'skipping line #{index}, could not parse it')
+            continue
+        if member:
+            yield member
+
+
+def _iter_signed_cards(members, executor=None):
+    # in the worker pool up to EXPORT_MAX_PENDING_CARDS cards are signed ahead, in order, which bounds the memory they take
+    if not executor:
+        for member in members:
+            yield member, create_apple_wallet_card(member.vcard_info)
+        return
+
+    pending_cards = collections.deque()
+    for member in members:
+        pending_cards.append((member, executor.submit(create_apple_wallet_card, member.vcard_info)))
+        if len(pending_cards) >= EXPORT_MAX_PENDING_CARDS:
+            member, apple_wallet_card_future = pending_cards.popleft()
+            yield member, apple_wallet_card_future.result()
+    while pending_cards:
+        member, apple_wallet_card_future = pending_cards.popleft()
+        yield member, apple_wallet_card_future.result()
+
+
+compiled_sms_templates = {
+    'issue': compile_template(SMS_TEMPLATE_ISSUE_SUCCESS),
+    'renewal_request': compile_template(SMS_TEMPLATE_RENEWAL_REQUEST),
+    'renewal_request_invalid_code': compile_template(SMS_TEMPLATE_RENEWAL_REQUEST_INVALID_CODE),
+}
+
+compiled_email_templates = {
+    'issue': (EMAIL_SUBJECT_ISSUE, compile_template(EMAIL_TEMPLATE_ISSUE_SUCCESS)),
+    'issue_missing_ducati_member_code': (EMAIL_SUBJECT_ISSUE, compile_template(f'{EMAIL_TEMPLATE_ISSUE_SUCCESS}\n{TEMPLATE_ISSUE_MISSING_DUCATI_MEMBER_CODE}')),
+    'renewal_request': (EMAIL_SUBJECT_RENEWAL_REQUEST, compile_template(EMAIL_TEMPLATE_RENEWAL_REQUEST)),
+    'renewal_request_invalid_code': (EMAIL_SUBJECT_RENEWAL_REQUEST, compile_template(EMAIL_TEMPLATE_RENEWAL_REQUEST_INVALID_CODE)),
+}
+
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--renewal-forecast', type=int, metavar='DAYS', help='print how many renewal reminders will be sent per day in the next DAYS days, without sending anything. '
+                        'reads the renewal index of STATE_DB_PATH, e.g. the state directory restored from the cron workflow cache, or builds it from the sheet when there is none')
+    parser.add_argument('--export-cards', metavar='PATH', help='sign the cards of all members into a .zip, .tar or .tar.gz archive laid out like the bucket, without updating the sheet')
+    parser.add_argument('--export-upload-key', metavar='KEY', help='upload the exported archive to the bucket under KEY')
+    parser.add_argument('--daemon', action='store_true', help='keep running, sync on an adaptive polling interval and whenever POST /sync is called on the trigger endpoint')
+    parser.add_argument('--trigger-host', default=DAEMON_TRIGGER_HOST, help='address of the trigger endpoint of --daemon')
+    parser.add_argument('--trigger-port', type=int, default=DAEMON_TRIGGER_PORT, help='port of the trigger endpoint of --daemon')
+    args = parser.parse_args()
+    if args.daemon:
+        run_daemon(args.trigger_host, args.trigger_port, DAEMON_TRIGGER_TOKEN)
+    elif args.renewal_forecast is not None:
+        print_renewal_forecast(args.renewal_forecast)
+    elif args.export_cards:
+        export_cards(args.export_cards, args.export_upload_key)
+    else:
+        main()
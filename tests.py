@@ -1,5 +1,82 @@
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import types
 import unittest
-from main import normalize_phone_number, normalize_email_address
+import urllib.error
+import urllib.request
+from unittest import mock
+import main
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError, HTTPClientError
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+import zipfile
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from main import normalize_phone_number, normalize_email_address, create_apple_wallet_card, ApplePassSigningContext, APPLE_CARD_RESOURCES, STATUS_ISSUE, STATUS_UPDATE_TYPO, STATUS_UPDATE, S3Publisher, SheetWriteBuffer, RateLimiter, CardStateStore, compute_card_content_hash, RowSnapshotStore, RenewalIndex, OutboxJournal, ShortLinkIndex, open_state_db, BulkEmailSender, compile_template
+
+
+def create_test_signing_context():
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'vcard-service-test')])
+    now = datetime.datetime.utcnow()
+    certificate = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(private_key.public_key()) \
+        .serial_number(1).not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1)) \
+        .sign(private_key, hashes.SHA256())
+    resource_files = {resource_name: resource_name.encode() for resource_name in APPLE_CARD_RESOURCES}
+    return ApplePassSigningContext(certificate, private_key, certificate, resource_files)
+
+
+def create_test_item(email_address='israel@example.com', phone_number='0505600011', bot_status=STATUS_ISSUE, **fields):
+    item = {
+        'כתובת אימייל': email_address,
+        'טלפון סלולרי': phone_number,
+        'חברות': '2026',
+        'קוד דוקאטי': '12345',
+        'תפקיד': '',
+        'שם מלא בעברית': 'ישראל ישראלי',
+        'שם מלא באנגלית': 'Israel Israeli',
+        'אישור': '',
+        'דגם אופנוע נוכחי': 'Monster',
+        'תפוגה': '2026-12-31',
+        'תאריך תזכורת חידוש אחרון': '',
+        'זוגי': '',
+        'עזב': '',
+        'סטטוס בוט': bot_status,
+        'id': 1,
+    }
+    item.update(fields)
+    return item
+
+
+def parse_test_item(item, now):
+    return main.MemberRowParser(list(item)).parse(item, now)
+
+
+TEST_VCARD_INFO = {
+    "hebrew_full_name": 'ישראל ישראלי',
+    "english_full_name": 'Israel Israeli',
+    "membership_year": '2026',
+    "membership_expiration": '2026-12-31',
+    "ducati_member_code": '12345',
+    "role": '',
+    "tags": [''],
+    "motorcycle_model": 'Monster',
+    "registration_type": 'יחיד',
+}
 
 
 class TestMain(unittest.TestCase):
@@ -24,3 +101,997 @@ class TestMain(unittest.TestCase):
         self.assertEqual('example@gmail.com', normalize_email_address('Example@gmail.com'))
         self.assertEqual('example@gmail.com', normalize_email_address(' ExampLe@gmail.Com'))
         self.assertEqual('example@gmail.com', normalize_email_address('\tExampLe@gmail.Com\t'))
+
+
+class TestApplePassSigningContext(unittest.TestCase):
+
+    def setUp(self):
+        self.signing_context = create_test_signing_context()
+
+    def test_create_apple_wallet_card(self):
+        apple_card = create_apple_wallet_card(TEST_VCARD_INFO, self.signing_context)
+        with zipfile.ZipFile(io.BytesIO(apple_card)) as zf:
+            self.assertEqual({'signature', 'manifest.json', 'pass.json', *APPLE_CARD_RESOURCES}, set(zf.namelist()))
+            manifest = json.loads(zf.read('manifest.json'))
+            self.assertEqual(hashlib.sha1(zf.read('pass.json')).hexdigest(), manifest['pass.json'])
+            for resource_name in APPLE_CARD_RESOURCES:
+                self.assertEqual(hashlib.sha1(zf.read(resource_name)).hexdigest(), manifest[resource_name])
+            pass_info = json.loads(zf.read('pass.json'))
+            self.assertEqual('rgb(204,0,0)', pass_info['backgroundColor'])
+
+    def test_resource_hashes_are_precomputed(self):
+        self.assertEqual(hashlib.sha1(b'logo.png').hexdigest(), self.signing_context.resource_hashes['logo.png'])
+
+
+class TestParseItem(unittest.TestCase):
+
+    def test_parse_item(self):
+        now = datetime.datetime(2026, 10, 17)
+        member = parse_test_item(create_test_item(), now)
+        self.assertEqual('israel@example.com', member.email_address)
+        self.assertEqual('+972505600011', member.phone_number)
+        self.assertEqual(hashlib.sha1(b'israel@example.com:+972505600011').hexdigest(), member.vcard_id)
+        self.assertEqual(member.vcard_id[:10], member.short_vcard_id)
+        self.assertEqual(datetime.datetime(2026, 12, 31), member.membership_expiration)
+        self.assertEqual(datetime.datetime(2000, 1, 1), member.last_renewal_reminder_date)
+        self.assertFalse(member.revoked)
+        self.assertEqual('2026-12-31', member.vcard_info['membership_expiration'])
+
+    def test_parse_item_without_status(self):
+        member = parse_test_item(create_test_item(bot_status='', **{'עזב': 'Y'}), datetime.datetime(2026, 10, 17))
+        self.assertTrue(member.revoked)
+        self.assertIsNone(member.vcard_info)
+
+    def test_parse_item_status_typo(self):
+        member = parse_test_item(create_test_item(bot_status=STATUS_UPDATE_TYPO), datetime.datetime(2026, 10, 17))
+        self.assertEqual(STATUS_UPDATE, member.bot_status)
+
+    def test_parse_item_empty_email(self):
+        self.assertIsNone(parse_test_item(create_test_item(email_address=''), datetime.datetime(2026, 10, 17)))
+
+    def test_parse_item_dates(self):
+        now = datetime.datetime(2026, 10, 17)
+        member = parse_test_item(create_test_item(**{'תפוגה': ' 2026-1-5 ', 'תאריך תזכורת חידוש אחרון': '17/10/2026'}), now)
+        self.assertEqual(datetime.datetime(2026, 1, 5), member.membership_expiration)
+        self.assertEqual(datetime.datetime(2000, 1, 1), member.last_renewal_reminder_date)
+        self.assertTrue(member.revoked)
+
+    def test_parse_item_without_optional_columns(self):
+        item = create_test_item()
+        del item['תאריך תזכורת חידוש אחרון'], item['סטטוס בוט']
+        member = parse_test_item(item, datetime.datetime(2026, 10, 17))
+        self.assertEqual(datetime.datetime(2000, 1, 1), member.last_renewal_reminder_date)
+        self.assertIsNone(member.vcard_info)
+
+    def test_missing_columns(self):
+        with self.assertRaisesRegex(ValueError, 'קוד דוקאטי'):
+            main.MemberRowParser([header for header in create_test_item() if header != 'קוד דוקאטי'])
+
+    def test_member_record_has_no_dict(self):
+        member = parse_test_item(create_test_item(), datetime.datetime(2026, 10, 17))
+        self.assertFalse(hasattr(member, '__dict__'))
+
+
+class TestParallelAppleWalletCards(unittest.TestCase):
+
+    def setUp(self):
+        main._apple_pass_signing_context = create_test_signing_context()
+
+    def tearDown(self):
+        main._apple_pass_signing_context = None
+
+    def test_submit_apple_wallet_cards(self):
+        now = datetime.datetime(2026, 10, 17)
+        items = [create_test_item(), create_test_item(bot_status=''), create_test_item(email_address='other@example.com')]
+        members = [(index, item, parse_test_item(item, now)) for index, item in enumerate(items)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+            apple_wallet_card_futures = main._submit_apple_wallet_cards(executor, members, main.OutboxJournal(open_state_db(':memory:')))
+            self.assertEqual([0, 2], list(apple_wallet_card_futures))
+            for apple_wallet_card_future in apple_wallet_card_futures.values():
+                with zipfile.ZipFile(io.BytesIO(apple_wallet_card_future.result())) as zf:
+                    self.assertIn('signature', zf.namelist())
+
+
+    def test_signing_executor_workers_inherit_the_signing_context(self):
+        # the environment has no signing key, the workers can only sign with the context of the parent
+        with mock.patch.object(main, 'APPLE_CARD_SIGNING_WORKERS', 2), main.create_apple_card_signing_executor() as executor:
+            with zipfile.ZipFile(io.BytesIO(executor.submit(create_apple_wallet_card, TEST_VCARD_INFO).result())) as zf:
+                self.assertIn('signature', zf.namelist())
+
+    def test_daemon_keeps_the_signing_executor(self):
+        import benchmark
+        with mock.patch.object(main, 'APPLE_CARD_SIGNING_WORKERS', 2), main.create_apple_card_signing_executor() as executor:
+            with mock.patch.object(main, '_apple_card_signing_executor', executor):
+                run = benchmark.run_benchmark(20, main._apple_pass_signing_context, signing_workers=2)
+                self.assertEqual(run['cards'], run['stages']['create_apple_wallet_card']['count'])
+            self.assertEqual(0, executor.submit(int).result())
+
+    def test_daemon_recreates_a_broken_signing_executor(self):
+        broken_executor = mock.Mock()
+        broken_executor.submit.return_value.result.side_effect = concurrent.futures.process.BrokenProcessPool()
+        with mock.patch.object(main, '_apple_card_signing_executor', broken_executor), mock.patch.object(main, 'create_apple_card_signing_executor') as create_apple_card_signing_executor, \
+                mock.patch.object(main, '_run_sync', return_value={'counters': {}}), self.assertLogs(level='WARNING'):
+            main._run_daemon_sync()
+            self.assertIs(create_apple_card_signing_executor.return_value, main._apple_card_signing_executor)
+        broken_executor.shutdown.assert_called_once_with(cancel_futures=True)
+
+
+class FakeS3Client:
+
+    def __init__(self, errors=None):
+        self.objects = {}
+        self.errors = errors or {}
+        self.thread_names = set()
+        self.lock = threading.Lock()
+
+        self.metadata = {}
+
+    def put_object(self, Body, Bucket, Key, ACL, Metadata=None, **extra_args):
+        with self.lock:
+            self.thread_names.add(threading.current_thread().name)
+            errors = self.errors.get(Key)
+            if errors:
+                raise ClientError({'Error': {'Code': errors.pop(0)}}, 'PutObject')
+            self.objects[(Bucket, Key)] = Body
+            self.metadata[(Bucket, Key)] = Metadata or {}
+        return {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        with open(Filename, 'rb') as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+    def get_paginator(self, operation_name):
+        def paginate(Bucket, Prefix):
+            return [{'Contents': [{'Key': key} for bucket, key in sorted(self.objects) if bucket == Bucket and key.startswith(Prefix)]}]
+        return types.SimpleNamespace(paginate=paginate)
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return {'Metadata': self.metadata[(Bucket, Key)]}
+
+
+class FakeS3Resource:
+
+    def __init__(self, s3_client):
+        self.meta = types.SimpleNamespace(client=s3_client)
+
+
+class TestS3Publisher(unittest.TestCase):
+
+    def test_only_the_publisher_client_skips_botocore_retries(self):
+        import boto3
+        services = main.ServiceContainer()
+        services.aws_session = boto3.Session(aws_access_key_id='key', aws_secret_access_key='secret', region_name='eu-central-1')
+        self.assertEqual(1, services.aws_s3_publisher_client.meta.config.retries['total_max_attempts'])
+        self.assertNotIn('total_max_attempts', services.aws_s3_resource.meta.client.meta.config.retries)
+
+    def test_put_object(self):
+        s3_client = FakeS3Client()
+        with S3Publisher(s3_client, 'bucket', max_concurrent_uploads=4, max_in_flight=2) as s3_publisher:
+            uploads = [s3_publisher.put_object(f'card/{index}.json', b'{}') for index in range(20)]
+            for upload in uploads:
+                upload.result()
+        self.assertEqual(20, len(s3_client.objects))
+        self.assertTrue(all(thread_name.startswith('s3-publisher') for thread_name in s3_client.thread_names))
+
+    def test_put_object_retries_transient_errors(self):
+        s3_client = FakeS3Client(errors={'card/1.json': ['SlowDown', 'InternalError']})
+        with S3Publisher(s3_client, 'bucket', retry_backoff_seconds=0) as s3_publisher:
+            s3_publisher.put_object('card/1.json', b'{}').result()
+        self.assertEqual(b'{}', s3_client.objects[('bucket', 'card/1.json')])
+
+    def test_put_object_retries_connection_errors(self):
+        s3_client = FakeS3Client()
+        errors = [EndpointConnectionError(endpoint_url='https://s3.amazonaws.com'), ConnectTimeoutError(endpoint_url='https://s3.amazonaws.com')]
+
+        def put_object(**kwargs):
+            if errors:
+                raise errors.pop(0)
+            return FakeS3Client.put_object(s3_client, **kwargs)
+        s3_client.put_object = mock.Mock(side_effect=put_object)
+        with S3Publisher(s3_client, 'bucket', retry_backoff_seconds=0) as s3_publisher:
+            s3_publisher.put_object('card/1.json', b'{}').result()
+        self.assertEqual(3, s3_client.put_object.call_count)
+        self.assertEqual(b'{}', s3_client.objects[('bucket', 'card/1.json')])
+
+    def test_put_object_fails_on_permanent_errors(self):
+        s3_client = FakeS3Client(errors={'card/1.json': ['AccessDenied']})
+        with S3Publisher(s3_client, 'bucket', retry_backoff_seconds=0) as s3_publisher:
+            with self.assertRaises(ClientError):
+                s3_publisher.put_object('card/1.json', b'{}').result()
+        self.assertEqual({}, s3_client.objects)
+
+
+class FakeSheetsRequest:
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def execute(self):
+        return self.callback()
+
+
+class FakeSheetsResource:
+
+    def __init__(self):
+        self.batch_updates = []
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def batchUpdate(self, spreadsheetId, body):
+        return FakeSheetsRequest(lambda: self.batch_updates.append((spreadsheetId, body)))
+
+
+class FakeSheetsClient:
+
+    def __init__(self, items, headers=None):
+        self.items = items
+        self.headers = headers if headers is not None else list(items[0]) if items else []
+        self.spreadsheet_id = 'spreadsheet'
+        self.spreadsheet_name = 'Sheet1'
+        self.google_sheets_resource = FakeSheetsResource()
+
+    def reload(self):
+        pass
+
+    def add_header(self, field_name):
+        self.headers.append(field_name)
+
+
+class TestSheetWriteBuffer(unittest.TestCase):
+
+    def test_flush(self):
+        items = [create_test_item(id=1), create_test_item(id=2)]
+        sheets_client = FakeSheetsClient(items, headers=['כתובת אימייל', 'סטטוס בוט'])
+        with SheetWriteBuffer(sheets_client, rate_limiter=RateLimiter('sheets', 1000)) as sheet_write_buffer:
+            sheet_write_buffer.set_item_field(items[0], 'סטטוס בוט', 'הנפקה - בוצע')
+            sheet_write_buffer.set_item_field(items[1], 'תאריך תזכורת חידוש אחרון', '2026-10-17')
+            sheet_write_buffer.set_item_field(items[0], 'סטטוס בוט', 'הנפקה - שגיאה')
+            self.assertEqual([], sheets_client.google_sheets_resource.batch_updates)
+
+        self.assertEqual('הנפקה - שגיאה', items[0]['סטטוס בוט'])
+        self.assertEqual(['כתובת אימייל', 'סטטוס בוט', 'תאריך תזכורת חידוש אחרון'], sheets_client.headers)
+        [(spreadsheet_id, body)] = sheets_client.google_sheets_resource.batch_updates
+        self.assertEqual('spreadsheet', spreadsheet_id)
+        self.assertEqual([('Sheet1!B2', [['הנפקה - שגיאה']]), ('Sheet1!C3', [['2026-10-17']])], [(data['range'], data['values']) for data in body['data']])
+
+    def test_flush_on_max_pending_updates(self):
+        items = [create_test_item(id=index) for index in range(1, 6)]
+        sheets_client = FakeSheetsClient(items)
+        sheet_write_buffer = SheetWriteBuffer(sheets_client, max_pending_updates=2, rate_limiter=RateLimiter('sheets', 1000))
+        for item in items:
+            sheet_write_buffer.set_item_field(item, 'סטטוס בוט', 'הנפקה - בוצע')
+        self.assertEqual([2, 2], [len(body['data']) for _, body in sheets_client.google_sheets_resource.batch_updates])
+
+    def test_flush_on_crash(self):
+        items = [create_test_item()]
+        sheets_client = FakeSheetsClient(items)
+        with self.assertRaises(RuntimeError):
+            with SheetWriteBuffer(sheets_client, rate_limiter=RateLimiter('sheets', 1000)) as sheet_write_buffer:
+                sheet_write_buffer.set_item_field(items[0], 'סטטוס בוט', 'שגיאה')
+                raise RuntimeError()
+        self.assertEqual(1, len(sheets_client.google_sheets_resource.batch_updates))
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_acquire(self):
+        clock = FakeClock()
+        rate_limiter = RateLimiter('ses', 2, burst=2, clock=clock, sleep=clock.sleep)
+        for _ in range(4):
+            rate_limiter.acquire()
+        self.assertEqual([0.5, 0.5], clock.sleeps)
+
+    def test_throttling_halves_the_rate(self):
+        clock = FakeClock()
+        rate_limiter = RateLimiter('ses', 8, clock=clock, sleep=clock.sleep)
+        responses = [ClientError({'Error': {'Code': 'Throttling'}}, 'SendRawEmail'), ClientError({'Error': {'Code': 'Throttling'}}, 'SendRawEmail'), 'sent']
+
+        def send():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        self.assertEqual('sent', rate_limiter.call(send))
+        self.assertAlmostEqual(2.8, rate_limiter.rate_per_second)
+        for _ in range(20):
+            rate_limiter.on_success()
+        self.assertEqual(8, rate_limiter.rate_per_second)
+
+    def test_sheets_too_many_requests(self):
+        clock = FakeClock()
+        rate_limiter = RateLimiter('sheets', 1, max_throttled_attempts=2, clock=clock, sleep=clock.sleep)
+
+        def update():
+            raise HttpError(Response({'status': 429}), b'')
+
+        with self.assertRaises(HttpError):
+            rate_limiter.call(update)
+        self.assertEqual(0.25, rate_limiter.rate_per_second)
+
+    def test_other_errors_are_not_retried(self):
+        rate_limiter = RateLimiter('s3', 100)
+        calls = []
+
+        def upload():
+            calls.append(1)
+            raise ClientError({'Error': {'Code': 'AccessDenied'}}, 'PutObject')
+
+        with self.assertRaises(ClientError):
+            rate_limiter.call(upload)
+        self.assertEqual(1, len(calls))
+
+
+class TestCardStateStore(unittest.TestCase):
+
+    def test_compute_card_content_hash(self):
+        self.assertEqual(compute_card_content_hash(TEST_VCARD_INFO), compute_card_content_hash(dict(reversed(list(TEST_VCARD_INFO.items())))))
+        self.assertNotEqual(compute_card_content_hash(TEST_VCARD_INFO), compute_card_content_hash({**TEST_VCARD_INFO, 'motorcycle_model': 'Panigale'}))
+
+    def test_content_hash(self):
+        card_state_store = CardStateStore(open_state_db(':memory:'))
+        self.assertIsNone(card_state_store.get_content_hash('vcard'))
+        card_state_store.set_content_hash('vcard', 'hash')
+        self.assertEqual('hash', card_state_store.get_content_hash('vcard'))
+
+    def test_content_hash_from_s3_metadata(self):
+        s3_client = FakeS3Client()
+        with S3Publisher(s3_client, 'bucket') as s3_publisher:
+            s3_publisher.put_object('card/vcard.json', b'{}', metadata={'content-hash': 'hash'}).result()
+            s3_publisher.put_object('apple_card/vcard.pkpass', b'', metadata={'content-hash': 'hash'}).result()
+        card_state_store = CardStateStore(open_state_db(':memory:'), s3_client, 'bucket')
+        self.assertEqual('hash', card_state_store.get_content_hash('vcard'))
+        self.assertIsNone(card_state_store.get_content_hash('other'))
+        s3_client.objects.clear()
+        self.assertEqual('hash', card_state_store.get_content_hash('vcard'))
+
+    def test_partially_published_card_has_no_content_hash(self):
+        s3_client = FakeS3Client()
+        with S3Publisher(s3_client, 'bucket') as s3_publisher:
+            s3_publisher.put_object('card/vcard.json', b'{}', metadata={'content-hash': 'hash'}).result()
+            s3_publisher.put_object('card/stale.json', b'{}', metadata={'content-hash': 'hash'}).result()
+            s3_publisher.put_object('apple_card/stale.pkpass', b'', metadata={'content-hash': 'old'}).result()
+        card_state_store = CardStateStore(open_state_db(':memory:'), s3_client, 'bucket')
+        self.assertIsNone(card_state_store.get_content_hash('vcard'))
+        self.assertIsNone(card_state_store.get_content_hash('stale'))
+
+    def test_content_hash_lookup_failure(self):
+        s3_client = FakeS3Client()
+        s3_client.head_object = mock.Mock(side_effect=[ClientError({'Error': {'Code': '403'}}, 'HeadObject'), HTTPClientError(error='connection reset')])
+        card_state_store = CardStateStore(open_state_db(':memory:'), s3_client, 'bucket')
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(card_state_store.get_content_hash('vcard'))
+            self.assertIsNone(card_state_store.get_content_hash('vcard'))
+
+    def test_mark_unchanged_cards(self):
+        now = datetime.datetime(2026, 10, 17)
+        items = [create_test_item(), create_test_item(email_address='other@example.com')]
+        members = [(index, item, parse_test_item(item, now)) for index, item in enumerate(items)]
+        card_state_store = CardStateStore(open_state_db(':memory:'))
+        card_state_store.set_content_hash(members[0][2].vcard_id, members[0][2].content_hash)
+        card_state_store.set_content_hash(members[1][2].vcard_id, 'stale')
+        main._mark_unchanged_cards(members, card_state_store)
+        self.assertEqual([True, False], [member.card_unchanged for _, _, member in members])
+
+
+class TestIncrementalIngestion(unittest.TestCase):
+
+    def setUp(self):
+        state_db = open_state_db(':memory:')
+        self.row_snapshot_store = RowSnapshotStore(state_db)
+        self.renewal_index = RenewalIndex(state_db)
+
+    def iter_changed_indexes(self, items, now, full_rescan=False):
+        indexes = [index for index, _, _ in main._iter_changed_members(items, main.MemberRowParser(main.MEMBER_REQUIRED_HEADERS), self.row_snapshot_store, self.renewal_index, full_rescan, now)]
+        self.row_snapshot_store.commit()
+        return indexes
+
+    def test_iter_changed_members(self):
+        now = datetime.datetime(2026, 10, 17)
+        items = [create_test_item(bot_status=''), create_test_item(email_address='other@example.com'), create_test_item(email_address='renewal@example.com', bot_status='', **{'תפוגה': '2026-11-01'})]
+        self.assertEqual([0, 1, 2], self.iter_changed_indexes(items, now))
+        self.assertEqual([1, 2], self.iter_changed_indexes(items, now))
+        self.assertEqual([0, 1, 2], self.iter_changed_indexes(items, now, full_rescan=True))
+
+        items[0]['דגם אופנוע נוכחי'] = 'Panigale'
+        self.assertEqual([0, 1, 2], self.iter_changed_indexes(items, now))
+
+    def test_unchanged_rows_due_for_renewal(self):
+        items = [create_test_item(bot_status='', **{'תפוגה': '2026-12-31'}), create_test_item(email_address='other@example.com', bot_status='', **{'תפוגה': '2027-06-01'})]
+        self.assertEqual([0, 1], self.iter_changed_indexes(items, datetime.datetime(2026, 10, 17)))
+        self.assertEqual([], self.iter_changed_indexes(items, datetime.datetime(2026, 11, 20)))
+        self.assertEqual([0], self.iter_changed_indexes(items, datetime.datetime(2026, 11, 30)))
+
+    def test_removed_rows_leave_the_renewal_index(self):
+        items = [create_test_item(bot_status='', **{'תפוגה': '2026-12-31'})]
+        self.iter_changed_indexes(items, datetime.datetime(2026, 10, 17))
+        self.assertEqual([], self.iter_changed_indexes([], datetime.datetime(2026, 11, 30)))
+        self.assertEqual([], self.renewal_index.get_due(datetime.datetime(2026, 11, 30)))
+
+    def test_full_rescan_due(self):
+        self.assertTrue(self.row_snapshot_store.is_full_rescan_due(datetime.datetime(2026, 10, 17), 24))
+        self.row_snapshot_store.set_last_full_rescan(datetime.datetime(2026, 10, 17))
+        self.assertFalse(self.row_snapshot_store.is_full_rescan_due(datetime.datetime(2026, 10, 17, 23), 24))
+        self.assertTrue(self.row_snapshot_store.is_full_rescan_due(datetime.datetime(2026, 10, 18), 24))
+
+
+class TestPlanWork(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime(2026, 12, 10)
+        self.weights = dict(main.WORK_PRIORITY_WEIGHTS)
+        self.quotas = {work_class: 1 for work_class in main.WORK_PRIORITY_WEIGHTS}
+
+    def create_members(self, items):
+        return [(index, item, parse_test_item(item, self.now)) for index, item in enumerate(items)]
+
+    def planned_indexes(self, members, max_document_updates):
+        return [index for index, _, _ in main._plan_work(members, self.now, max_document_updates, self.weights, self.quotas)]
+
+    def test_new_cards_before_updates_and_renewals(self):
+        members = self.create_members([
+            create_test_item(email_address='update@example.com', bot_status=STATUS_UPDATE, **{'תפוגה': '2027-06-01'}),
+            create_test_item(email_address='renewal@example.com', bot_status=''),
+            create_test_item(email_address='unchanged@example.com', bot_status='', **{'תפוגה': '2027-06-01'}),
+            create_test_item(email_address='issue@example.com', **{'תפוגה': '2027-06-01'}),
+        ])
+        self.assertEqual([3], self.planned_indexes(members, 1))
+        self.assertEqual([0, 3], self.planned_indexes(members, 2))
+        self.assertEqual([0, 1, 3], self.planned_indexes(members, 10))
+
+    def test_errors_first(self):
+        members = self.create_members([create_test_item(email_address='issue@example.com')]) + [(1, {}, ValueError('missing email')), (2, {}, None)]
+        self.assertEqual([1], self.planned_indexes(members, 1))
+
+    def test_card_with_renewal_costs_two_updates(self):
+        members = self.create_members([create_test_item(email_address='issue@example.com'), create_test_item(email_address='other@example.com', **{'תפוגה': '2027-06-01'})])
+        self.assertEqual([1], self.planned_indexes(members, 1))
+        self.assertEqual([0], self.planned_indexes(members, 2))
+
+    def test_quota_leaves_room_for_lower_priority(self):
+        members = self.create_members([create_test_item(email_address=f'update{index}@example.com', bot_status=STATUS_UPDATE, **{'תפוגה': '2027-06-01'}) for index in range(4)]
+                                      + [create_test_item(email_address=f'renewal{index}@example.com', bot_status='') for index in range(4)])
+        self.quotas[main.WORK_CLASS_UPDATE] = 0.5
+        self.assertEqual([0, 1, 4, 5], self.planned_indexes(members, 4))
+
+    def test_unused_budget_goes_past_the_quota(self):
+        members = self.create_members([create_test_item(email_address=f'update{index}@example.com', bot_status=STATUS_UPDATE, **{'תפוגה': '2027-06-01'}) for index in range(4)])
+        self.quotas[main.WORK_CLASS_UPDATE] = 0.25
+        self.assertEqual([0, 1, 2], self.planned_indexes(members, 3))
+
+
+class TestOutboxJournal(unittest.TestCase):
+
+    def setUp(self):
+        main._apple_pass_signing_context = create_test_signing_context()
+        self.state_db = open_state_db(':memory:')
+        self.now = datetime.datetime(2026, 10, 17)
+        self.items = [create_test_item(id=1)]
+        self.sheets_client = FakeSheetsClient(self.items)
+        self.s3_client = FakeS3Client()
+
+    def tearDown(self):
+        main._apple_pass_signing_context = None
+        self.state_db.close()
+
+    def process_members(self, max_pending_updates=main.SHEET_WRITE_BUFFER_MAX_UPDATES):
+        members = [(0, self.items[0], parse_test_item(self.items[0], self.now))]
+        outbox = OutboxJournal(self.state_db)
+        sheet_write_buffer = SheetWriteBuffer(self.sheets_client, max_pending_updates=max_pending_updates, rate_limiter=RateLimiter('sheets', 1000))
+        sheet_write_buffer.after_flush = outbox.flush_completed
+        with S3Publisher(self.s3_client, 'bucket', rate_limiter=RateLimiter('s3', 1000)) as s3_publisher:
+            short_link_index = ShortLinkIndex(self.state_db, self.s3_client, 'bucket')
+            main._process_members(members, {}, s3_publisher, sheet_write_buffer, CardStateStore(self.state_db), None, outbox, short_link_index, self.now)
+        return sheet_write_buffer, outbox
+
+    def test_kept_across_schema_versions(self):
+        with tempfile.TemporaryDirectory() as state_dir:
+            db_path = os.path.join(state_dir, 'state.sqlite3')
+            state_db = open_state_db(db_path)
+            OutboxJournal(state_db).record('vcard', [main.OUTBOX_STEP_ISSUE_NOTIFIED])
+            CardStateStore(state_db).set_content_hash('vcard', 'hash')
+            state_db.close()
+            with mock.patch.object(main, 'STATE_DB_SCHEMA_VERSION', main.STATE_DB_SCHEMA_VERSION + 1):
+                state_db = open_state_db(db_path)
+            self.assertTrue(OutboxJournal(state_db).has_step('vcard', main.OUTBOX_STEP_ISSUE_NOTIFIED))
+            self.assertIsNone(CardStateStore(state_db).get_content_hash('vcard'))
+            state_db.close()
+
+    def test_flush_of_the_last_row_update_completes_the_row(self):
+        self.items[0]['תפוגה'] = (self.now + datetime.timedelta(days=10)).strftime('%Y-%m-%d')
+        with mock.patch.object(main, '_send_issue_notification'), mock.patch.object(main, '_send_renewal_notification'):
+            sheet_write_buffer, _ = self.process_members(max_pending_updates=1)
+        self.assertEqual({}, sheet_write_buffer.pending_updates)
+        self.assertEqual(2, len(self.sheets_client.google_sheets_resource.batch_updates[0][1]['data']))
+        self.assertEqual([], self.state_db.execute('SELECT vcard_id, step FROM outbox').fetchall())
+
+    def test_resume_interrupted_run(self):
+        with mock.patch.object(main, '_send_issue_notification', side_effect=SystemExit()) as send_issue_notification:
+            with self.assertRaises(SystemExit):
+                self.process_members()
+        send_issue_notification.assert_called_once()
+        self.assertEqual(3, len(self.s3_client.objects))
+
+        # the cancelled run didn't write the sheet, the next run only writes it
+        self.s3_client.objects.clear()
+        with mock.patch.object(main, '_send_issue_notification') as send_issue_notification, mock.patch.object(main, 'create_apple_wallet_card') as create_apple_wallet_card:
+            sheet_write_buffer, outbox = self.process_members()
+            self.assertEqual({}, self.s3_client.objects)
+            sheet_write_buffer.flush()
+        send_issue_notification.assert_not_called()
+        create_apple_wallet_card.assert_not_called()
+        self.assertEqual('הנפקה - בוצע', self.items[0]['סטטוס בוט'])
+        self.assertEqual(0, self.state_db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0])
+
+    def test_resume_signed_card(self):
+        member = parse_test_item(self.items[0], self.now)
+        OutboxJournal(self.state_db).record(member.vcard_id, [main.OUTBOX_STEP_SIGNED], member.content_hash, b'signed card')
+        with mock.patch.object(main, '_send_issue_notification'), mock.patch.object(main, 'create_apple_wallet_card') as create_apple_wallet_card:
+            self.process_members()
+        create_apple_wallet_card.assert_not_called()
+        self.assertEqual(b'signed card', self.s3_client.objects[('bucket', f'apple_card/{member.vcard_id}.pkpass')])
+
+    def test_steps_of_changed_card_are_not_reused(self):
+        member = parse_test_item(self.items[0], self.now)
+        outbox = OutboxJournal(self.state_db)
+        outbox.record(member.vcard_id, [main.OUTBOX_STEP_SIGNED], 'old content hash', b'old card')
+        self.assertIsNone(OutboxJournal(self.state_db).get_payload(member.vcard_id, main.OUTBOX_STEP_SIGNED, member.content_hash))
+
+
+class TestShortLinkIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.state_db = open_state_db(':memory:')
+        self.s3_client = FakeS3Client()
+        self.rate_limiters = main.rate_limiters
+        main.rate_limiters = dict(main.rate_limiters, s3=RateLimiter('s3', 1000))
+
+    def tearDown(self):
+        main.rate_limiters = self.rate_limiters
+
+    def get_shard(self, shard):
+        return json.loads(self.s3_client.objects[('bucket', f'short_index/{shard}.json')])
+
+    def test_flush_changed_shards(self):
+        short_link_index = ShortLinkIndex(self.state_db, self.s3_client, 'bucket')
+        short_link_index.add('ab00000001', 'ab00000001full')
+        short_link_index.add('ab00000002', 'ab00000002full')
+        short_link_index.add('cd00000001', 'cd00000001full')
+        short_link_index.flush()
+        self.assertEqual({'ab00000001': 'ab00000001full', 'ab00000002': 'ab00000002full'}, self.get_shard('ab'))
+        self.assertEqual({'cd00000001': 'cd00000001full'}, self.get_shard('cd'))
+
+        self.s3_client.objects.pop(('bucket', 'short_index/cd.json'))
+        short_link_index.add('ab00000001', 'ab00000001full')
+        short_link_index.add('ab00000003', 'ab00000003full')
+        short_link_index.flush()
+        self.assertEqual(3, len(self.get_shard('ab')))
+        self.assertNotIn(('bucket', 'short_index/cd.json'), self.s3_client.objects)
+
+    def test_load_shard_from_s3(self):
+        self.s3_client.objects[('bucket', 'short_index/ab.json')] = json.dumps({'ab00000001': 'ab00000001full'}).encode()
+        short_link_index = ShortLinkIndex(self.state_db, self.s3_client, 'bucket')
+        short_link_index.add('ab00000002', 'ab00000002full')
+        short_link_index.flush()
+        self.assertEqual({'ab00000001': 'ab00000001full', 'ab00000002': 'ab00000002full'}, self.get_shard('ab'))
+
+    def test_failed_upload_is_retried_by_the_next_run(self):
+        self.s3_client.errors['short_index/ab.json'] = ['AccessDenied']
+        short_link_index = ShortLinkIndex(self.state_db, self.s3_client, 'bucket')
+        short_link_index.add('ab00000001', 'ab00000001full')
+        short_link_index.flush()
+        self.assertNotIn(('bucket', 'short_index/ab.json'), self.s3_client.objects)
+
+        ShortLinkIndex(self.state_db, self.s3_client, 'bucket').flush()
+        self.assertEqual({'ab00000001': 'ab00000001full'}, self.get_shard('ab'))
+
+    def test_unreadable_shard_is_not_overwritten(self):
+        self.s3_client.objects[('bucket', 'short_index/ab.json')] = json.dumps({'ab00000001': 'ab00000001full'}).encode()
+        get_object = self.s3_client.get_object
+        self.s3_client.get_object = mock.Mock(side_effect=ClientError({'Error': {'Code': '503'}}, 'GetObject'))
+        short_link_index = ShortLinkIndex(self.state_db, self.s3_client, 'bucket')
+        with self.assertLogs(level='WARNING'):
+            short_link_index.add('ab00000002', 'ab00000002full')
+            short_link_index.add('ab00000003', 'ab00000003full')
+            short_link_index.flush()
+        self.assertEqual(2, self.s3_client.get_object.call_count)
+        self.assertEqual({'ab00000001': 'ab00000001full'}, self.get_shard('ab'))
+
+        self.s3_client.get_object = get_object
+        ShortLinkIndex(self.state_db, self.s3_client, 'bucket').flush()
+        self.assertEqual(['ab00000001', 'ab00000002', 'ab00000003'], sorted(self.get_shard('ab')))
+
+    def test_failed_upload_does_not_stop_the_sheet_flush(self):
+        short_link_index = ShortLinkIndex(self.state_db, self.s3_client, 'bucket')
+        self.s3_client.put_object = mock.Mock(side_effect=EndpointConnectionError(endpoint_url='https://s3.amazonaws.com'))
+        sheets_client = FakeSheetsClient([create_test_item()])
+        with self.assertLogs(level='ERROR'):
+            with SheetWriteBuffer(sheets_client, rate_limiter=RateLimiter('sheets', 1000)) as sheet_write_buffer:
+                sheet_write_buffer.before_flush = short_link_index.flush
+                short_link_index.add('ab00000001', 'ab00000001full')
+                sheet_write_buffer.set_item_field(sheets_client.items[0], main.HEADER_BOT_STATUS, 'done')
+        self.assertEqual(1, len(sheets_client.google_sheets_resource.batch_updates))
+        self.assertEqual({'ab'}, short_link_index.changed_shards)
+
+    def test_backfill_only_published_cards(self):
+        now = datetime.datetime.now()
+        items = [create_test_item(id=1, **{'סטטוס בוט': f'{STATUS_ISSUE} - {main.STATUS_DONE}'}),
+                 create_test_item(email_address='pending@example.com', id=2),
+                 create_test_item(email_address='revoked@example.com', id=3, **{'סטטוס בוט': f'{STATUS_ISSUE} - {main.STATUS_DONE}', 'עזב': 'y'}),
+                 create_test_item(email_address='cleared@example.com', bot_status='', id=4),
+                 create_test_item(email_address='never@example.com', bot_status='', id=5)]
+        members = [parse_test_item(item, now) for item in items]
+        for member in members[:3]:
+            self.s3_client.objects[('bucket', f'short/{member.short_vcard_id}.json')] = b'{}'
+        self.s3_client.objects.pop(('bucket', f'short/{members[1].short_vcard_id}.json'))
+        with tempfile.TemporaryDirectory() as state_dir, mock.patch.object(main, 'STATE_DB_PATH', os.path.join(state_dir, 'state.sqlite3')), \
+                mock.patch.object(main, 'services', main.ServiceContainer()), mock.patch.object(main, '_apple_pass_signing_context', create_test_signing_context()), \
+                mock.patch.object(main, 'rate_limiters', {name: RateLimiter(name, 1000) for name in main.RATE_LIMITS_PER_SECOND}), mock.patch.object(main, 'MAX_DOCUMENT_UPDATES', 0):
+            main.services.google_sheets_client = FakeSheetsClient(items)
+            main.services.aws_s3_resource = FakeS3Resource(self.s3_client)
+            main.services.aws_s3_publisher_client = self.s3_client
+            main.services.aws_ses_client = FakeSESClient()
+            main.services.aws_s3_bucket_name = 'bucket'
+            with contextlib.closing(open_state_db(main.STATE_DB_PATH)) as state_db:
+                CardStateStore(state_db).set_content_hash(members[3].vcard_id, 'hash')
+            main._sync()
+        short_links = {}
+        for _, key in list(self.s3_client.objects):
+            if key.startswith('short_index/'):
+                short_links.update(self.get_shard(key[len('short_index/'):-len('.json')]))
+        self.assertEqual({member.short_vcard_id: member.vcard_id for member in [members[0], members[2], members[3]]}, short_links)
+
+    def test_list_short_link_objects(self):
+        self.s3_client.objects[('bucket', 'short/ab00000001.json')] = b'{}'
+        self.s3_client.objects[('bucket', 'short_index/ab.json')] = b'{}'
+        short_link_index = ShortLinkIndex(self.state_db, self.s3_client, 'bucket')
+        self.assertEqual({'ab00000001'}, short_link_index.list_short_link_objects())
+        self.s3_client.get_paginator = mock.Mock(side_effect=ClientError({'Error': {'Code': 'AccessDenied'}}, 'ListObjectsV2'))
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(set(), short_link_index.list_short_link_objects())
+
+    def test_short_link_objects_flag(self):
+        member = parse_test_item(create_test_item(), datetime.datetime(2026, 10, 17))
+        with mock.patch.object(main, 'SHORT_LINK_OBJECTS', False):
+            self.assertEqual([f'card/{member.vcard_id}.json'], [key for key, _, _ in main._get_card_json_objects(member)])
+        self.assertEqual([f'card/{member.vcard_id}.json', f'short/{member.short_vcard_id}.json'], [key for key, _, _ in main._get_card_json_objects(member)])
+
+
+class TestExportCards(unittest.TestCase):
+
+    def setUp(self):
+        main._apple_pass_signing_context = create_test_signing_context()
+        self.items = [create_test_item(id=1), create_test_item(email_address='', id=2), create_test_item(email_address='other@example.com', bot_status='', id=3)]
+        self.services = main.services
+        main.services = main.ServiceContainer()
+        main.services.google_sheets_client = FakeSheetsClient(self.items)
+        main.services.aws_s3_resource = FakeS3Resource(FakeS3Client())
+        main.services.aws_s3_bucket_name = 'bucket'
+        self.rate_limiters = main.rate_limiters
+        main.rate_limiters = dict(main.rate_limiters, sheets=RateLimiter('sheets', 1000))
+
+    def tearDown(self):
+        main._apple_pass_signing_context = None
+        main.services = self.services
+        main.rate_limiters = self.rate_limiters
+
+    def get_short_link_shards(self):
+        now = datetime.datetime.now()
+        short_link_shards = collections.defaultdict(dict)
+        for index in [0, 2]:
+            member = parse_test_item(self.items[index], now)
+            short_link_shards[f'short_index/{member.short_vcard_id[:2]}.json'][member.short_vcard_id] = member.vcard_id
+        return short_link_shards
+
+    def test_export_zip(self):
+        now = datetime.datetime.now()
+        vcard_ids = [parse_test_item(self.items[index], now).vcard_id for index in [0, 2]]
+        short_link_shards = self.get_short_link_shards()
+        with tempfile.TemporaryDirectory() as export_dir:
+            archive_path = os.path.join(export_dir, 'cards.zip')
+            main.export_cards(archive_path, upload_key='exports/cards.zip')
+            with zipfile.ZipFile(archive_path) as zf:
+                self.assertEqual(sorted([f'card/{vcard_id}.json' for vcard_id in vcard_ids] + [f'short/{vcard_id[:10]}.json' for vcard_id in vcard_ids] + [f'apple_card/{vcard_id}.pkpass' for vcard_id in vcard_ids] + list(short_link_shards)), sorted(zf.namelist()))
+                for shard_name, short_links in short_link_shards.items():
+                    self.assertEqual(short_links, json.loads(zf.read(shard_name)))
+                self.assertEqual('Israel Israeli', json.loads(zf.read(f'card/{vcard_ids[1]}.json'))['english_full_name'])
+                with zipfile.ZipFile(io.BytesIO(zf.read(f'apple_card/{vcard_ids[0]}.pkpass'))) as pkpass_zf:
+                    self.assertIn('signature', pkpass_zf.namelist())
+            with open(archive_path, 'rb') as f:
+                self.assertEqual(f.read(), main.services.aws_s3_resource.meta.client.objects[('bucket', 'exports/cards.zip')])
+
+    def test_export_tar(self):
+        with tempfile.TemporaryDirectory() as export_dir:
+            archive_path = os.path.join(export_dir, 'cards.tar.gz')
+            main.export_cards(archive_path)
+            with tarfile.open(archive_path) as tf:
+                self.assertEqual(6 + len(self.get_short_link_shards()), len(tf.getnames()))
+
+    def test_export_without_short_link_objects(self):
+        with tempfile.TemporaryDirectory() as export_dir, mock.patch.object(main, 'SHORT_LINK_OBJECTS', False):
+            archive_path = os.path.join(export_dir, 'cards.zip')
+            with self.assertLogs(level='INFO') as logs:
+                main.export_cards(archive_path)
+            with zipfile.ZipFile(archive_path) as zf:
+                self.assertEqual(sorted(self.get_short_link_shards()), sorted(name for name in zf.namelist() if name.startswith('short')))
+        self.assertIn(f'exported 2 cards and {len(self.get_short_link_shards())} short link index shards', logs.output[-1])
+
+
+class TestRenewalIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.renewal_index = RenewalIndex(open_state_db(':memory:'))
+        self.now = datetime.datetime(2026, 10, 17)
+
+    def add_member(self, email_address, membership_expiration, last_renewal_reminder_date=''):
+        item = create_test_item(email_address=email_address, bot_status='', **{'תפוגה': membership_expiration, 'תאריך תזכורת חידוש אחרון': last_renewal_reminder_date})
+        member = parse_test_item(item, self.now)
+        self.renewal_index.update(member, 'fingerprint')
+        return member
+
+    def test_get_due(self):
+        due_member = self.add_member('due@example.com', '2026-11-01')
+        self.add_member('reminded@example.com', '2026-11-01', '2026-10-10')
+        self.add_member('later@example.com', '2027-06-01')
+        self.add_member('expired@example.com', '2026-01-01')
+        self.assertEqual([(due_member.vcard_id, 'fingerprint')], self.renewal_index.get_due(self.now))
+        self.assertTrue(main._is_renewal_notification_due(due_member, self.now))
+
+    def test_get_due_matches_renewal_notification_due(self):
+        member = self.add_member('member@example.com', '2026-12-31')
+        for days in range(0, 120):
+            now = self.now + datetime.timedelta(days=days, hours=12)
+            if main._is_renewal_notification_due(member, now):
+                self.assertEqual(1, len(self.renewal_index.get_due(now)))
+
+    def test_get_upcoming(self):
+        self.add_member('due@example.com', '2026-11-01')
+        self.add_member('later@example.com', '2026-12-31')
+        self.add_member('next_year@example.com', '2027-06-01')
+        reminder_dates = [reminder_date.date() for reminder_date, _ in self.renewal_index.get_upcoming(self.now, 60)]
+        self.assertEqual([datetime.date(2026, 10, 17), datetime.date(2026, 11, 1), datetime.date(2026, 11, 29), datetime.date(2026, 12, 14)], reminder_dates)
+
+    def test_renewal_forecast_from_the_sheet_without_state(self):
+        now = datetime.datetime.now()
+        items = [create_test_item(bot_status='', **{'תפוגה': (now + datetime.timedelta(days=10)).strftime('%Y-%m-%d')}),
+                 create_test_item(email_address='later@example.com', bot_status='', **{'תפוגה': (now + datetime.timedelta(days=400)).strftime('%Y-%m-%d')})]
+        with tempfile.TemporaryDirectory() as state_dir, mock.patch.object(main, 'STATE_DB_PATH', os.path.join(state_dir, 'state.sqlite3')), \
+                mock.patch.object(main, 'services', main.ServiceContainer()), mock.patch.object(main, 'rate_limiters', dict(main.rate_limiters, sheets=RateLimiter('sheets', 1000))), \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            main.services.google_sheets_client = FakeSheetsClient(items)
+            main.print_renewal_forecast(30)
+        self.assertEqual('total\t1', stdout.getvalue().splitlines()[-1])
+
+
+class FakeSESClient:
+
+    def __init__(self, failed_recipients=(), template_error=None):
+        self.templates = {}
+        self.bulk_emails = []
+        self.raw_emails = []
+        self.failed_recipients = failed_recipients
+        self.template_error = template_error
+
+    def create_template(self, Template):
+        if self.template_error:
+            raise ClientError({'Error': {'Code': self.template_error}}, 'CreateTemplate')
+        if Template['TemplateName'] in self.templates:
+            raise ClientError({'Error': {'Code': 'AlreadyExists'}}, 'CreateTemplate')
+        self.templates[Template['TemplateName']] = Template
+
+    def send_bulk_templated_email(self, Source, Template, DefaultTemplateData, Destinations):
+        self.bulk_emails.append((Template, Destinations))
+        return {'Status': [{'Status': 'Failed' if destination['Destination']['ToAddresses'][0] in self.failed_recipients else 'Success'} for destination in Destinations]}
+
+    def send_raw_email(self, Source, Destinations, RawMessage):
+        self.raw_emails.append((Destinations, RawMessage))
+
+
+class TestTemplates(unittest.TestCase):
+
+    def test_compile_template(self):
+        template_data = {'hebrew_full_name': 'ישראל ישראלי', 'membership_expiration': '31/12/2026', 'ducati_member_code': '12345', 'card_url': 'https://card.docil.co.il/#/abc'}
+        expected = main.EMAIL_TEMPLATE_ISSUE_SUCCESS
+        for placeholder_name, value in template_data.items():
+            expected = expected.replace('{{' + placeholder_name + '}}', value)
+        self.assertEqual(expected, compile_template(main.EMAIL_TEMPLATE_ISSUE_SUCCESS)(template_data))
+        self.assertEqual('a1b2', compile_template('a{{x}}b{{y}}')({'x': '1', 'y': '2'}))
+        self.assertEqual('plain', compile_template('plain')({}))
+
+
+class TestBulkEmailSender(unittest.TestCase):
+
+    def setUp(self):
+        self.original_services = main.services
+        main.services = main.ServiceContainer()
+        main.services.aws_ses_client = FakeSESClient()
+        main.services.contact_phone_number = '972500000000'
+
+    def tearDown(self):
+        main.services = self.original_services
+
+    def create_email_sender(self, ses_client):
+        return BulkEmailSender(ses_client, batch_size=50, rate_limiter=RateLimiter('ses', 1000, burst=1000))
+
+    def test_send_in_batches(self):
+        ses_client = FakeSESClient()
+        with self.create_email_sender(ses_client) as email_sender:
+            for index in range(120):
+                main._send_renewal_notification('12345', f'member{index}@example.com', 'ישראל ישראלי', '+972505600011', datetime.datetime(2026, 11, 1), 15, email_sender)
+            main._send_renewal_notification('', 'nocode@example.com', 'ישראל ישראלי', '+972505600011', datetime.datetime(2026, 11, 1), 15, email_sender)
+            self.assertEqual([50, 50], [len(destinations) for _, destinations in ses_client.bulk_emails])
+
+        self.assertEqual([50, 50, 20, 1], [len(destinations) for _, destinations in ses_client.bulk_emails])
+        self.assertEqual(2, len(ses_client.templates))
+        template_name, destinations = ses_client.bulk_emails[0]
+        self.assertIn('{{membership_expiration}}', ses_client.templates[template_name]['TextPart'])
+        self.assertEqual('01/11/2026 (בעוד 15 ימים)', json.loads(destinations[0]['ReplacementTemplateData'])['membership_expiration'])
+        self.assertEqual([], ses_client.raw_emails + main.services.aws_ses_client.raw_emails)
+
+    def test_failed_recipients_fall_back_to_raw_emails(self):
+        ses_client = FakeSESClient(failed_recipients=['failed@example.com'])
+        with self.create_email_sender(ses_client) as email_sender:
+            main._send_issue_notification('12345', 'member@example.com', 'ישראל ישראלי', '+972505600011', 'abc', datetime.datetime(2026, 12, 31), email_sender)
+            main._send_issue_notification('12345', 'failed@example.com', 'ישראל ישראלי', '+972505600011', 'abc', datetime.datetime(2026, 12, 31), email_sender)
+        self.assertEqual([['failed@example.com']], [destinations for destinations, _ in main.services.aws_ses_client.raw_emails])
+
+    def test_template_errors_fall_back_to_raw_emails(self):
+        ses_client = FakeSESClient(template_error='AccessDenied')
+        with self.create_email_sender(ses_client) as email_sender:
+            main._send_issue_notification('', 'member@example.com', 'ישראל ישראלי', '+972505600011', 'abc', datetime.datetime(2026, 12, 31), email_sender)
+        self.assertEqual([], ses_client.bulk_emails)
+        [(destinations, raw_message)] = main.services.aws_ses_client.raw_emails
+        self.assertEqual(['member@example.com'], destinations)
+
+
+class TestImportTime(unittest.TestCase):
+    IMPORT_TIME_BUDGET_SECONDS = 0.3
+
+    def test_import_without_secrets(self):
+        environment = {name: value for name, value in os.environ.items() if name in ['PATH', 'HOME', 'PYTHONPATH']}
+        script = 'import sys, main; print(sorted({"boto3", "gdolim", "cryptography", "applepassgenerator"} & set(sys.modules)))'
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)), env=environment, capture_output=True, text=True, check=True)
+        self.assertEqual('[]', result.stdout.strip())
+        main_import_time_line = [line for line in result.stderr.splitlines() if line.endswith('| main')][-1]
+        main_import_time_seconds = int(main_import_time_line.split('|')[1]) / 1_000_000
+        self.assertLess(main_import_time_seconds, self.IMPORT_TIME_BUDGET_SECONDS)
+
+
+class TestRunMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.run_metrics = main.RunMetrics()
+        for seconds in range(1, 101):
+            self.run_metrics.record('s3_put', seconds / 1000)
+        self.run_metrics.increment('published_cards', 3)
+
+    def test_summary(self):
+        summary = self.run_metrics.summary()
+        self.assertEqual({'published_cards': 3}, summary['counters'])
+        self.assertEqual({'count': 100, 'total_seconds': 5.05, 'p50_seconds': 0.051, 'p95_seconds': 0.096, 'max_seconds': 0.1}, summary['stages']['s3_put'])
+
+    def test_timed(self):
+        with self.assertRaises(RuntimeError):
+            with self.run_metrics.timed('sheet_flush'):
+                raise RuntimeError()
+        self.assertEqual(1, self.run_metrics.summary()['stages']['sheet_flush']['count'])
+
+    def test_write_run_metrics(self):
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            json_path = os.path.join(metrics_dir, 'run_metrics.json')
+            prometheus_path = os.path.join(metrics_dir, 'vcard.prom')
+            main.write_run_metrics(self.run_metrics.summary(), json_path, prometheus_path)
+            with open(json_path) as f:
+                self.assertEqual(100, json.load(f)['stages']['s3_put']['count'])
+            with open(prometheus_path) as f:
+                prometheus_lines = f.read().splitlines()
+        self.assertIn('vcard_sync_stage_duration_seconds{stage="s3_put",quantile="0.95"} 0.096', prometheus_lines)
+        self.assertIn('vcard_sync_stage_duration_seconds_count{stage="s3_put"} 100', prometheus_lines)
+        self.assertIn('vcard_sync_events{event="published_cards"} 3', prometheus_lines)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_benchmark(self):
+        import benchmark
+        run = benchmark.run_benchmark(50, create_test_signing_context())
+        self.assertEqual(50, run['rows'])
+        self.assertGreater(run['cards'], 0)
+        self.assertEqual(50, run['stages']['parse_item']['count'])
+        self.assertEqual(run['cards'], run['stages']['create_apple_wallet_card']['count'])
+        self.assertEqual(run['cards'] * 3, run['stages']['s3_put']['count'])
+        self.assertEqual(run['cards'], run['counters']['published_cards'])
+        self.assertLessEqual(run['stages']['parse_item']['p50_seconds'], run['stages']['parse_item']['p95_seconds'])
+
+    def test_find_regressions(self):
+        import benchmark
+        baseline_results = {'runs': [{'rows': 100, 'rows_per_second': 1000, 'cards_per_second': 100}]}
+        results = {'runs': [{'rows': 100, 'rows_per_second': 700, 'cards_per_second': 95}]}
+        self.assertEqual(['100 rows: rows_per_second dropped from 1000 to 700'], benchmark.find_regressions(results, baseline_results))
+
+
+class TestSyncDaemon(unittest.TestCase):
+
+    def create_sync_daemon(self, summaries):
+        def sync():
+            summary = summaries.pop(0)
+            if isinstance(summary, Exception):
+                raise summary
+            if not summaries:
+                sync_daemon.stop()
+            intervals.append(sync_daemon.poll_interval_seconds)
+            return summary
+
+        intervals = []
+        sync_daemon = main.SyncDaemon(sync, 0.001, 0.004)
+        return sync_daemon, intervals
+
+    def test_poll_interval_backs_off_while_idle(self):
+        idle_summary = {'counters': {'changed_rows': 1}}
+        sync_daemon, intervals = self.create_sync_daemon([idle_summary, idle_summary, idle_summary, idle_summary, {'counters': {'changed_rows': 1, 'planned_issue': 1}}, idle_summary])
+        sync_daemon.run()
+        self.assertEqual([0.001, 0.002, 0.004, 0.004, 0.004, 0.001], intervals)
+        self.assertEqual(0.002, sync_daemon.poll_interval_seconds)
+        self.assertEqual(6, sync_daemon.syncs_count)
+
+    def test_deferred_work_polls_again_soon(self):
+        sync_daemon, _ = self.create_sync_daemon([{'counters': {}}, {'counters': {'deferred_issue': 3}}])
+        sync_daemon.run()
+        self.assertEqual(0.001, sync_daemon.poll_interval_seconds)
+
+    def test_failed_sync_backs_off(self):
+        sync_daemon, _ = self.create_sync_daemon([RuntimeError('sheets unavailable'), {'counters': {}}])
+        with self.assertLogs(level='ERROR'):
+            sync_daemon.run()
+        self.assertEqual(2, sync_daemon.syncs_count)
+        self.assertFalse(sync_daemon.last_sync_failed)
+
+    def test_trigger_endpoint(self):
+        sync_daemon = main.SyncDaemon(lambda: {'counters': {}}, 60, 60)
+        trigger_server = main.create_sync_trigger_server(sync_daemon, '127.0.0.1', 0, 'secret')
+        threading.Thread(target=trigger_server.serve_forever, daemon=True).start()
+        try:
+            url = f'http://127.0.0.1:{trigger_server.server_port}'
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(urllib.request.Request(f'{url}/sync', data=b'', headers={'X-Trigger-Token': 'wrong'}))
+            self.assertEqual(403, context.exception.code)
+            self.assertFalse(sync_daemon.sync_requested.is_set())
+
+            with urllib.request.urlopen(urllib.request.Request(f'{url}/sync', data=b'', headers={'X-Trigger-Token': 'secret'})) as response:
+                self.assertEqual(202, response.status)
+            self.assertTrue(sync_daemon.sync_requested.is_set())
+
+            with urllib.request.urlopen(f'{url}/health') as response:
+                self.assertEqual({'syncs': 0, 'last_sync_at': None, 'last_sync_failed': False, 'poll_interval_seconds': 60}, json.loads(response.read()))
+        finally:
+            trigger_server.shutdown()
+            trigger_server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()